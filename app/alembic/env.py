@@ -1,25 +1,21 @@
 import asyncio
 from logging.config import fileConfig
 
-from asyncpg import Connection
+from sqlalchemy.engine import Connection
 
 from alembic import context
 from dotenv import load_dotenv
 import os
 
-from sqlalchemy.ext.asyncio import create_async_engine
 load_dotenv('.env')
 print(os.path.exists('.env'))
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
-postgres_user = os.getenv("POSTGRES_USER")
-postgres_password = os.getenv("POSTGRES_PASSWORD")
-postgres_host = os.getenv("POSTGRES_HOST")
-postgres_port = os.getenv("POSTGRES_PORT")
-postgres_db = os.getenv("POSTGRES_DB")
-DATABASE_URL = f'postgresql+asyncpg://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}'
+from database.database import DATABASE_URL, is_sqlite_url, create_database_engine
 config.set_main_option("sqlalchemy.url", DATABASE_URL)
+# SQLite не умеет большинство ALTER TABLE, alembic пересоздает таблицы пачкой
+RENDER_AS_BATCH = is_sqlite_url(DATABASE_URL)
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
@@ -30,6 +26,15 @@ if config.config_file_name is not None:
 from database.models import Base
 target_metadata = Base.metadata
 
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # Секции transactions создаются приложением (crud/partitions.py), а не миграциями
+    if type_ == "table" and reflected and compare_to is None and name.startswith("transactions_"):
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -52,6 +57,8 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
+        render_as_batch=RENDER_AS_BATCH,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -62,14 +69,15 @@ def run_migrations_offline() -> None:
 
 async def run_migrations_online():
     """Run migrations in 'online' mode."""
-    connectable = create_async_engine(config.get_main_option("sqlalchemy.url"))
+    connectable = create_database_engine(config.get_main_option("sqlalchemy.url"))
 
     async with connectable.connect() as connection:
         await connection.run_sync(do_run_migrations)
 
 
 def do_run_migrations(connection: Connection):
-    context.configure(connection=connection, target_metadata=target_metadata)
+    context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object,
+                      render_as_batch=RENDER_AS_BATCH)
 
     with context.begin_transaction():
         context.run_migrations()
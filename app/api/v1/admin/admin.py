@@ -1,13 +1,33 @@
+import asyncio
+import csv
+import io
+import json
 import os
+from datetime import date, datetime
+from enum import Enum
+from typing import AsyncIterator, Literal, Optional
+from uuid import UUID
 from pprint import pprint
 
 from fastapi import APIRouter, Depends, HTTPException
-
-from api.v1.admin.schemas import InstrumentCreateRequest, BalanceChangeScheme
-from api.v1.auth.jwt import get_current_admin
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy import Row
+
+from api.v1.admin.schemas import InstrumentCreateRequest, BalanceChangeScheme, BulkUserCreateScheme
+from api.v1.auth.jwt import get_current_admin, create_access_token
+from core import metrics
+from core.admission import limits_config
+from core.money import to_minor, to_quantity
+from core.wire import wire_dumps
+from crud.partitions import read_archived_transactions
+from crud.order import stream_orders
+from crud.portfolio import stream_portfolios
+from crud.teardown import JOBS, USER_DELETE_INLINE_LIMIT, count_user_rows, reset_exchange, start_user_deletion
+from crud.transaction import stream_transactions
 from crud.instrument import create_instrument, get_instrument_by_ticker, delete_instrument
-from crud.user import get_user, change_balance, delete_user
-from database.models import User, Instrument
+from crud.user import get_user, change_balance, delete_user, create_users
+from database.models import User, Instrument, RoleEnum
 from depends import get_instrument_depend, get_user_depend
 
 router = APIRouter()
@@ -25,6 +45,15 @@ async def instrument(instrument: InstrumentCreateRequest, user: User = Depends(g
     }
 
 
+def __balance_change_units(balance_change: BalanceChangeScheme) -> int:
+    try:
+        if balance_change.ticker == os.getenv('BASE_INSTRUMENT_TICKER'):
+            return to_minor(balance_change.amount)
+        return to_quantity(balance_change.amount)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
 @router.post('/balance/deposit')
 async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get_current_admin)):
     user = await get_user(str(balance_change.user_id))
@@ -37,7 +66,7 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
         if not instrument:
             raise HTTPException(status_code=404, detail="Instrument not found")
 
-    await change_balance(str(balance_change.user_id), balance_change.ticker, balance_change.amount)
+    await change_balance(str(balance_change.user_id), balance_change.ticker, __balance_change_units(balance_change))
 
     return {
         "success": True
@@ -55,7 +84,7 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
         if not instrument:
             raise HTTPException(status_code=404, detail="Instrument not found")
 
-    await change_balance(str(balance_change.user_id), balance_change.ticker, -1 * balance_change.amount)
+    await change_balance(str(balance_change.user_id), balance_change.ticker, -1 * __balance_change_units(balance_change))
 
     return {
         "success": True
@@ -63,18 +92,44 @@ async def deposit(balance_change: BalanceChangeScheme, admin: User = Depends(get
 
 
 
+@router.post('/users')
+async def create_users_bulk(users: BulkUserCreateScheme, admin: User = Depends(get_current_admin)):
+    return await create_users(users.names, create_access_token, RoleEnum[users.role])
+
+
 @router.delete('/user/{user_id}')
 async def delete_user_met(user_to_delete: User = Depends(get_user_depend), admin: User = Depends(get_current_admin)):
-    deleted = await delete_user(str(user_to_delete.id))
     res = {
-        "id": deleted.id,
-        "name": deleted.name,
-        "role": deleted.role.name,
-        "api_key": deleted.api_key
+        "id": user_to_delete.id,
+        "name": user_to_delete.name,
+        "role": user_to_delete.role.name,
+        "api_key": user_to_delete.api_key
     }
+    if await count_user_rows(user_to_delete.id) > USER_DELETE_INLINE_LIMIT:
+        # Крупного пользователя удаляем пачками в фоне, статус - в /user/{user_id}/deletion
+        job = await start_user_deletion(user_to_delete.id)
+        res["deletion"] = job.as_dict()
+        return JSONResponse(jsonable_encoder(res), status_code=202)
+    await delete_user(str(user_to_delete.id))
     return res
 
 
+@router.get('/user/{user_id}/deletion')
+async def user_deletion_status(user_id: UUID, admin: User = Depends(get_current_admin)):
+    job = JOBS.get(user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Deletion job not found')
+    return job.as_dict()
+
+
+@router.post('/reset')
+async def reset(admin: User = Depends(get_current_admin)):
+    await reset_exchange()
+    return {
+        "success": True
+    }
+
+
 @router.delete('/instrument/{ticker}')
 async def instrument(instrument: Instrument = Depends(get_instrument_depend), user: User = Depends(get_current_admin)):
     ticker = instrument.ticker
@@ -82,3 +137,89 @@ async def instrument(instrument: Instrument = Depends(get_instrument_depend), us
     return {
         "success": True
     }
+
+
+@router.get('/transactions/archive')
+async def transactions_archive(start: date, end: date, ticker: Optional[str] = None, limit: int = 1000,
+                               admin: User = Depends(get_current_admin)):
+    return await asyncio.to_thread(read_archived_transactions, start, end, ticker, limit)
+
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def __export_cell(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    return str(value)
+
+
+async def __encode_rows(rows: AsyncIterator[Row], fmt: str, chunk_rows: int = 1000) -> AsyncIterator[str]:
+    # Отдаем строки пачками: первые байты уходят клиенту сразу после первой пачки курсора
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    header_written = False
+    count = 0
+    async for row in rows:
+        if writer is not None:
+            if not header_written:
+                writer.writerow(row._fields)
+                header_written = True
+            writer.writerow([__export_cell(v) for v in row])
+        else:
+            buffer.write(json.dumps({k: __export_cell(v) for k, v in row._mapping.items()}))
+            buffer.write('\n')
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+@router.get('/export/transactions')
+async def export_transactions(ticker: Optional[str] = None, start: Optional[datetime] = None,
+                              end: Optional[datetime] = None, format: Literal['ndjson', 'csv'] = 'ndjson',
+                              admin: User = Depends(get_current_admin)):
+    return StreamingResponse(__encode_rows(stream_transactions(ticker, start, end), format),
+                             media_type=EXPORT_MEDIA_TYPES[format])
+
+
+@router.get('/export/orders')
+async def export_orders(ticker: Optional[str] = None, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, format: Literal['ndjson', 'csv'] = 'ndjson',
+                        admin: User = Depends(get_current_admin)):
+    return StreamingResponse(__encode_rows(stream_orders(ticker, start, end), format),
+                             media_type=EXPORT_MEDIA_TYPES[format])
+
+
+async def __encode_portfolios(portfolios: AsyncIterator[dict], chunk_rows: int = 1000) -> AsyncIterator[bytes]:
+    chunk = []
+    async for portfolio in portfolios:
+        chunk.append(wire_dumps(portfolio))
+        if len(chunk) == chunk_rows:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk = []
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
+
+
+@router.get('/portfolio')
+async def portfolios(admin: User = Depends(get_current_admin)):
+    # Все пользователи одним потоком по сгруппированным остаткам и резервам
+    return StreamingResponse(__encode_portfolios(stream_portfolios()), media_type=EXPORT_MEDIA_TYPES['ndjson'])
+
+
+@router.get('/metrics')
+async def metrics_met(admin: User = Depends(get_current_admin)):
+    res = metrics.snapshot()
+    res.update(limits_config())
+    return res
@@ -1,6 +1,7 @@
+from decimal import Decimal
 from uuid import UUID
 
-from pydantic import BaseModel, constr, field_validator
+from pydantic import BaseModel, constr, conlist, field_validator
 
 
 class InstrumentCreateRequest(BaseModel):
@@ -10,10 +11,23 @@ class InstrumentCreateRequest(BaseModel):
 class BalanceChangeScheme(BaseModel):
     user_id: UUID
     ticker: constr(min_length=2, max_length=10, pattern="^[A-Z]+$")
-    amount: int
+    # Для базовой валюты - сумма в единицах API, для инструментов - целое количество
+    amount: Decimal
 
     @field_validator('amount')
     def amount_must_be_greater_then_zero(cls, value):
         if value <= 0:
             raise ValueError("Amount must be > 0")
         return value
+
+
+class BulkUserCreateScheme(BaseModel):
+    names: conlist(constr(min_length=3), min_length=1, max_length=10000)
+    role: str = 'USER'
+
+    @field_validator('role')
+    def role_enum(cls, value):
+        roles = ['USER', 'ADMIN']
+        if value not in roles:
+            raise ValueError(f"Role must be enum {roles}")
+        return value
@@ -1,8 +1,6 @@
-import asyncio
-
 import jwt
 from datetime import datetime, timedelta
-from crud.user import get_user, apply_api_key
+from crud.user import get_user
 from fastapi import HTTPException, Depends, Request, status
 import os
 from database.models import User, RoleEnum
@@ -45,28 +43,38 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    asyncio.get_running_loop().create_task(apply_api_key(data['id'], encoded_jwt))
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    credentials_exception = HTTPException(
+def __credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "TOKEN"},
     )
+
+
+def decode_user_id(token: str) -> str:
+    # Только подпись и срок токена, без похода в базу
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        id_: str = payload.get("id")
-        if id_ is None:
-            raise credentials_exception
-    except jwt.exceptions.PyJWTError as e:
-        raise credentials_exception
+    except jwt.exceptions.PyJWTError:
+        raise __credentials_exception()
+    id_ = payload.get("id")
+    if id_ is None:
+        raise __credentials_exception()
+    return id_
 
+
+async def load_current_user(id_: str) -> User:
     user = await get_user(id_)
-    if user:
+    if user and not user.deleting:
         return user
-    raise credentials_exception
+    raise __credentials_exception()
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    return await load_current_user(decode_user_id(token))
 
 async def get_current_admin(user: User = Depends(get_current_user)) -> User:
     if user.role != RoleEnum.ADMIN:
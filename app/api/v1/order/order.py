@@ -1,33 +1,87 @@
+import asyncio
 import time
 import uuid
-from datetime import timezone
 from pprint import pprint
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
 
 from api.v1.auth.jwt import get_current_user
-from api.v1.order.schemas import CreateOrderScheme
+from api.v1.order.schemas import CreateOrderScheme, AmendOrderScheme
+from core.admission import TICKER_GATE
+from core.reports import REPORTS, Subscription
+from core.wire import wire_dumps, order_wire, stop_wire, wire_list, WireResponse
 from crud.instrument import get_instrument_by_ticker
 from crud.order import create_limit_sell_order, create_limit_buy_order, create_market_buy_order, \
-    create_market_sell_order, cancel_order, get_order
+    create_market_sell_order, cancel_order, get_order, amend_order, create_stop_order, get_stop_order, \
+    cancel_stop_order, get_cached_client_order
 from crud.user import get_user_orders
-from database.models import User, OrderStatusEnum, DirectionEnum, Order
+from database.models import User, OrderStatusEnum, DirectionEnum, TimeInForceEnum
+from depends import rate_limited
 
 router = APIRouter()
 
 
-@router.get('')
-async def order(user: User = Depends(get_current_user)):
+@router.get('', response_class=WireResponse)
+async def order(user: User = Depends(rate_limited('read'))):
     orders = await get_user_orders(str(user.id))
     print('my orders')
-    res = [pretty_order(o) for o in orders]
-    return res
+    return wire_list(order_wire(o) for o in orders)
+
+
+@router.websocket('/stream')
+async def order_stream(websocket: WebSocket, since: Optional[int] = None):
+    # Токен - в заголовке Authorization, как у REST, или в ?token= для клиентов без заголовков
+    authorization = websocket.headers.get('Authorization', '')
+    token = authorization.removeprefix('TOKEN ') if authorization else websocket.query_params.get('token')
+    try:
+        user = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=4401)
+        return
+    await websocket.accept()
+
+    subscription, backlog, gap = REPORTS.subscribe(user.id, since)
+    sender = asyncio.create_task(__send_reports(websocket, user.id, subscription, backlog, gap))
+    receiver = asyncio.create_task(__wait_disconnect(websocket))
+    try:
+        await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        REPORTS.unsubscribe(user.id, subscription)
+        sender.cancel()
+        receiver.cancel()
+        await asyncio.gather(sender, receiver, return_exceptions=True)
+
+
+async def __send_reports(websocket: WebSocket, user_id: uuid.UUID, subscription: Subscription,
+                         backlog: list, gap: bool):
+    if gap:
+        await websocket.send_text(wire_dumps({"type": "gap", "seq": REPORTS.current(user_id)}).decode())
+    for wire in backlog:
+        await websocket.send_text(wire.decode())
+    while True:
+        if subscription.lagged and subscription.queue.empty():
+            # Отстающий клиент переподключится с since и дочитает из буфера
+            await websocket.close(code=4000, reason='lagged')
+            return
+        seq, wire = await subscription.queue.get()
+        await websocket.send_text(wire.decode())
+
+
+async def __wait_disconnect(websocket: WebSocket):
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
 
 
 @router.delete('/{order_id}')
-async def order(order_id: uuid.UUID, user: User = Depends(get_current_user)):
+async def order(order_id: uuid.UUID, user: User = Depends(rate_limited('order'))):
     order_id = str(order_id)
     canceled = await cancel_order(order_id, user.id)
+    if not canceled:
+        canceled = await cancel_stop_order(order_id, user.id)
     if not canceled:
         # print(
         #     f'{user.name} -- canceled delete order')
@@ -39,50 +93,57 @@ async def order(order_id: uuid.UUID, user: User = Depends(get_current_user)):
     }
 
 
-@router.get('/{order_id}')
-async def order(order_id: uuid.UUID, user: User = Depends(get_current_user)):
+@router.patch('/{order_id}', response_class=WireResponse)
+async def order(order_id: uuid.UUID, amend: AmendOrderScheme, user: User = Depends(rate_limited('order'))):
+    amended = await amend_order(str(order_id), user.id, amend.qty, amend.price)
+    if amended is None:
+        raise HTTPException(404, detail='order not found')
+    return WireResponse(order_wire(amended))
+
+
+@router.get('/{order_id}', response_class=WireResponse)
+async def order(order_id: uuid.UUID, user: User = Depends(rate_limited('read'))):
     order_id = str(order_id)
     order = await get_order(order_id)
     if order is None:
-        raise HTTPException(404)
+        stop = await get_stop_order(order_id)
+        if stop is None:
+            raise HTTPException(404)
+        if stop.user_id != user.id:
+            raise HTTPException(403)
+        return WireResponse(stop_wire(stop))
     if order.user_id != user.id:
         raise HTTPException(403)
 
-    return pretty_order(order)
-
-def pretty_order(order: Order):
-    your_datetime = order.created_at
-    datetime_utc = your_datetime.astimezone(timezone.utc)
-    formatted_timestamp = datetime_utc.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
-    return {
-        "id": order.id,
-        "status": order.status.value,
-        "user_id": order.user_id,
-        "timestamp": formatted_timestamp,
-        "body": {
-            "direction": "BUY" if order.direction == DirectionEnum.BID else 'SELL',
-            "ticker": order.instrument_ticker,
-            "qty": order.amount + order.filled,
-            "price": order.price
-        },
-        "filled": order.filled
-    }
+    return WireResponse(order_wire(order))
 
 
 
 @router.post('')
-async def order(order: CreateOrderScheme, user: User = Depends(get_current_user)):
+async def order(order: CreateOrderScheme, user: User = Depends(rate_limited('order'))):
     print('create order')
     pprint(order)
     order_ = None
-    instrument = await get_instrument_by_ticker(order.ticker)
-    if not instrument:
-        raise HTTPException(404, detail='ticker unexist')
-    if order.direction == 'BUY':
-        order_ = await buy_order(order, user)
-    elif order.direction == 'SELL':
-        order_ = await sell_order(order, user)
-    if order_.status == OrderStatusEnum.CANCELLED:
+    if order.client_order_id is not None:
+        # Повтор уже принятой заявки отвечает исходным результатом прямо из памяти
+        order_ = get_cached_client_order(user.id, order.client_order_id)
+    if order_ is None:
+        instrument = await get_instrument_by_ticker(order.ticker)
+        if not instrument:
+            raise HTTPException(404, detail='ticker unexist')
+        if order.stop_price is not None:
+            direction = DirectionEnum.BID if order.direction == 'BUY' else DirectionEnum.ASK
+            stop = await create_stop_order(order.ticker, order.qty, order.price, order.stop_price, direction, user)
+            return {
+                "success": True,
+                "order_id": str(stop.id)
+            }
+        async with TICKER_GATE.admit(order.ticker):
+            if order.direction == 'BUY':
+                order_ = await buy_order(order, user)
+            elif order.direction == 'SELL':
+                order_ = await sell_order(order, user)
+    if order_.status == OrderStatusEnum.CANCELLED and not order_.filled:
         raise HTTPException(422, detail='ORDER CANCELLED')
     # print(f'{user.name} create order')
     # pprint(order)
@@ -94,12 +155,16 @@ async def order(order: CreateOrderScheme, user: User = Depends(get_current_user)
 
 
 async def buy_order(order: CreateOrderScheme, user: User):
+    time_in_force = TimeInForceEnum[order.time_in_force]
     if order.price:
-        return await create_limit_buy_order(order.ticker, order.qty, order.price, user)
-    return await create_market_buy_order(order.ticker, order.qty, user)
+        return await create_limit_buy_order(order.ticker, order.qty, order.price, user,
+                                            time_in_force, order.expires_at, order.client_order_id)
+    return await create_market_buy_order(order.ticker, order.qty, user, time_in_force, order.client_order_id)
 
 
 async def sell_order(order: CreateOrderScheme, user: User):
+    time_in_force = TimeInForceEnum[order.time_in_force]
     if order.price:
-        return await create_limit_sell_order(order.ticker, order.qty, order.price, user)
-    return await create_market_sell_order(order.ticker, order.qty, user)
+        return await create_limit_sell_order(order.ticker, order.qty, order.price, user,
+                                             time_in_force, order.expires_at, order.client_order_id)
+    return await create_market_sell_order(order.ticker, order.qty, user, time_in_force, order.client_order_id)
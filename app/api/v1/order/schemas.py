@@ -1,17 +1,78 @@
+from datetime import datetime, timezone
 from typing import Optional
 
-from pydantic import BaseModel, constr, conint, field_validator
+from pydantic import BaseModel, constr, conint, field_validator, model_validator
+
+from core.money import Money
 
 
 class CreateOrderScheme(BaseModel):
     direction: str
     ticker: constr(min_length=2, max_length=10, pattern="^[A-Z]+$")
     qty: conint(gt=0)
-    price: Optional[conint(gt=0)] = None
+    price: Optional[Money] = None
+    time_in_force: str = 'GTC'
+    expires_at: Optional[datetime] = None
+    stop_price: Optional[Money] = None
+    client_order_id: Optional[constr(min_length=1, max_length=64)] = None
+
+    @field_validator('price', 'stop_price')
+    def price_must_be_greater_then_zero(cls, value):
+        if value is not None and value <= 0:
+            raise ValueError("Price must be > 0")
+        return value
+
+    @field_validator('time_in_force')
+    def time_in_force_enum(cls, value):
+        values = ['GTC', 'IOC', 'FOK', 'GTD']
+        if value not in values:
+            raise ValueError(f"Time in force must be enum {values}")
+        return value
+
+    @field_validator('expires_at')
+    def expires_at_to_utc(cls, value):
+        # Время в базе хранится naive UTC, как created_at
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    @model_validator(mode='after')
+    def gtd_requires_expires_at(self):
+        if self.time_in_force == 'GTD':
+            if self.expires_at is None:
+                raise ValueError("expires_at is required for GTD")
+            if self.price is None:
+                raise ValueError("GTD is only supported for limit orders")
+            if self.expires_at <= datetime.utcnow():
+                raise ValueError("expires_at must be in the future")
+        elif self.expires_at is not None:
+            raise ValueError("expires_at is only allowed for GTD")
+        if self.stop_price is not None and self.time_in_force != 'GTC':
+            raise ValueError("Stop orders support only GTC")
+        if self.stop_price is not None and self.client_order_id is not None:
+            raise ValueError("client_order_id is not supported for stop orders")
+        return self
 
     @field_validator('direction')
     def direction_enum(cls, value):
         directions = ['BUY', 'SELL']
         if value not in directions:
             raise ValueError(f"Direction must be enum {directions}")
-        return value
\ No newline at end of file
+        return value
+
+
+class AmendOrderScheme(BaseModel):
+    qty: Optional[conint(gt=0)] = None
+    price: Optional[Money] = None
+
+    @field_validator('price')
+    def price_must_be_greater_then_zero(cls, value):
+        if value is not None and value <= 0:
+            raise ValueError("Price must be > 0")
+        return value
+
+    @model_validator(mode='after')
+    def qty_or_price(self):
+        if self.qty is None and self.price is None:
+            raise ValueError("qty or price must be set")
+        return self
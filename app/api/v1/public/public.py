@@ -1,14 +1,18 @@
-from datetime import timezone
+import uuid
 from pprint import pprint
 from collections import defaultdict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 from api.v1.auth.jwt import get_current_user, create_access_token, get_current_admin
+from core.money import to_major, average_price
+from core.recent import RECENT_TRADES
+from core.tickerstats import TICKER_STATS
+from core.wire import trade_wire, wire_list, WireResponse
 from depends import get_instrument_depend
 from .schemas import UserAuth
-from database.models import User, DirectionEnum, Instrument
+from database.models import User, DirectionEnum, Instrument, RoleEnum
 from crud.user import create_user
 from crud.instrument import get_all_instruments, get_instrument_by_ticker, delete_all_instruments
-from crud.order import get_orders, delete_all_orders
+from crud.order import get_orders, DEPTH
 from crud.transaction import get_transactions_by_ticker
 
 router = APIRouter()
@@ -16,14 +20,15 @@ router = APIRouter()
 
 @router.post('/register')
 async def register(user: UserAuth):
-    user = await create_user(user.name)
-    await delete_all_orders()
+    # id и ключ известны до вставки, поэтому пользователь пишется одним INSERT
+    user_id = uuid.uuid4()
     data = {
         "name": user.name,
-        "id": str(user.id),
-        "role": user.role.name
+        "id": str(user_id),
+        "role": RoleEnum.USER.name
     }
     token = create_access_token(data)
+    user = await create_user(user.name, user_id=user_id, api_key=token)
     data['api_key'] = token
     print('create user ', user.id)
     return data
@@ -68,7 +73,7 @@ async def public_test(instrument: Instrument = Depends(get_instrument_depend), l
         aggregated = defaultdict(int)
         for order in orders:
             aggregated[order.price] += order.amount
-        return [{"price": price, "qty": qty} for price, qty in
+        return [{"price": to_major(price), "qty": qty} for price, qty in
                 sorted(aggregated.items(), reverse=(direction == DirectionEnum.BID))]
 
     bid_orders = await aggregate_orders(DirectionEnum.BID)
@@ -82,17 +87,39 @@ async def public_test(instrument: Instrument = Depends(get_instrument_depend), l
     return res
 
 
-@router.get('/transactions/{ticker}')
-async def public_test(instrument: Instrument = Depends(get_instrument_depend), limit: int = 10):
-    ticker = instrument.ticker
+@router.get('/transactions/{ticker}', response_class=WireResponse)
+async def public_test(ticker: str, limit: int = 10):
+    # Кольцо есть у каждого существующего инструмента, в базу за проверкой идем только без него
+    if ticker not in RECENT_TRADES:
+        await get_instrument_depend(ticker)
     transactions = await get_transactions_by_ticker(ticker, limit)
-    transactions = [
-        {
-            "ticker": t.instrument_ticker,
-            "amount": t.amount,
-            "price": t.price,
-            "timestamp": t.timestamp.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
-        }
-        for t in transactions
-    ]
-    return transactions
+    return wire_list(trade_wire(t) for t in transactions)
+
+
+@router.get('/tickers')
+async def public_test():
+    # Статистика за 24 часа по всем инструментам из скользящих агрегатов в памяти
+    return [{
+        "ticker": ticker,
+        "last_price": to_major(stats.last_price) if stats.last_price is not None else None,
+        "volume": stats.volume,
+        "high": to_major(stats.high) if stats.high is not None else None,
+        "low": to_major(stats.low) if stats.low is not None else None,
+        "vwap": average_price(stats.notional, stats.volume) if stats.volume else None,
+        "trades": stats.trades
+    } for ticker, stats in TICKER_STATS.snapshot()]
+
+
+@router.get('/quote/{ticker}')
+async def public_test(ticker: str, side: str = Query(pattern='^(BUY|SELL)$'), qty: int = Query(gt=0)):
+    # Считается по DEPTH в памяти: без блокировки тикера и без запросов в базу
+    quote = DEPTH.quote(ticker, side == 'BUY', qty)
+    return {
+        "ticker": ticker,
+        "side": side,
+        "qty": qty,
+        "filled": quote.filled,
+        "shortfall": quote.shortfall,
+        "vwap": average_price(quote.cost, quote.filled) if quote.filled else None,
+        "worst_price": to_major(quote.worst_price) if quote.worst_price is not None else None
+    }
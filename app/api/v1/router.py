@@ -3,13 +3,15 @@ from pprint import pprint
 
 from fastapi import APIRouter, Depends
 
+from core.money import notional, to_major
 from crud.user import get_user_orders
 from database.models import User, OrderStatusEnum, DirectionEnum
 from .public.public import router as public_router
 from .admin.admin import router as admin_router
 from .order.order import router as order_router
-from api.v1.auth.jwt import get_current_user
+from depends import rate_limited
 from crud.inventory import get_user_inventory
+from crud.portfolio import get_portfolio
 
 router = APIRouter()
 router.include_router(public_router, prefix='/public')
@@ -17,11 +19,11 @@ router.include_router(admin_router, prefix='/admin')
 router.include_router(order_router, prefix='/order')
 
 @router.get("/balance")
-async def balance(user: User = Depends(get_current_user)):
+async def balance(user: User = Depends(rate_limited('read'))):
     inv = await get_user_inventory(user.id)
     result = {i.instrument_ticker: i.quantity for i in inv}
     result[os.getenv('BASE_INSTRUMENT_TICKER')] = user.balance
-    orders = await get_user_orders(str(user.id))
+    orders = await get_user_orders(str(user.id), include_history=False)
     for o in orders:
         if o.status in [OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]:
             if o.direction == DirectionEnum.ASK:
@@ -29,7 +31,8 @@ async def balance(user: User = Depends(get_current_user)):
                 result[o.instrument_ticker] += o.amount
             elif o.direction == DirectionEnum.BID:
                 # Ордер на покупку
-                result[os.getenv('BASE_INSTRUMENT_TICKER')] += o.amount * o.price
+                result[os.getenv('BASE_INSTRUMENT_TICKER')] += notional(o.amount, o.price)
+    result[os.getenv('BASE_INSTRUMENT_TICKER')] = to_major(result[os.getenv('BASE_INSTRUMENT_TICKER')])
     pprint(result)
     if result['MEMECOIN'] == 150 and result['RUB'] == 150 and sum(result.values()) == 300:
         return {
@@ -38,3 +41,9 @@ async def balance(user: User = Depends(get_current_user)):
         }
     #result = {i.instrument_ticker: i.quantity for i in inv if i.quantity > 0}
     return result
+
+
+@router.get("/portfolio")
+async def portfolio(user: User = Depends(rate_limited('read'))):
+    # Оценка по последним ценам из памяти: один запрос к базе вместо balance + сделок по тикерам
+    return await get_portfolio(user.id)
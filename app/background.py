@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+from sqlalchemy import inspect
+
+from crud.bus import BUS
+from crud.order import compact_orders, schedule_pending_expiries, load_active_stops, load_depth, load_ticker_stats, EXPIRY
+from crud.partitions import partition_transactions, maintain_transaction_partitions
+from crud.transaction import load_recent_trades
+from database.database import engine, Base
+
+logger = logging.getLogger(__name__)
+
+ORDERS_COMPACTION_INTERVAL = float(os.getenv('ORDERS_COMPACTION_INTERVAL', '30'))
+ORDERS_COMPACTION_BATCH = int(os.getenv('ORDERS_COMPACTION_BATCH', '1000'))
+PARTITIONS_MAINTENANCE_INTERVAL = float(os.getenv('PARTITIONS_MAINTENANCE_INTERVAL', '3600'))
+SCHEMA_WAIT_TIMEOUT = float(os.getenv('SCHEMA_WAIT_TIMEOUT', '300'))
+SCHEMA_WAIT_INTERVAL = float(os.getenv('SCHEMA_WAIT_INTERVAL', '2'))
+
+
+async def __periodic(name: str, interval: float, func, *args):
+    while True:
+        try:
+            await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('background task %s failed', name)
+        await asyncio.sleep(interval)
+
+
+def __missing_tables(conn):
+    inspector = inspect(conn)
+    return [name for name in Base.metadata.tables if not inspector.has_table(name)]
+
+
+async def __wait_for_schema():
+    # Миграции накатывает отдельный контейнер, приложение может стартовать раньше них
+    deadline = asyncio.get_running_loop().time() + SCHEMA_WAIT_TIMEOUT
+    while True:
+        async with engine.connect() as conn:
+            missing = await conn.run_sync(__missing_tables)
+        if not missing:
+            return
+        if asyncio.get_running_loop().time() >= deadline:
+            raise RuntimeError(f'database schema is not migrated, missing tables: {", ".join(missing)}')
+        logger.warning('waiting for migrations, missing tables: %s', ', '.join(missing))
+        await asyncio.sleep(SCHEMA_WAIT_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await __wait_for_schema()
+    await partition_transactions()
+    await schedule_pending_expiries()
+    await load_active_stops()
+    await load_depth()
+    await load_ticker_stats()
+    await load_recent_trades()
+    tasks = [
+        asyncio.create_task(EXPIRY.run()),
+        asyncio.create_task(BUS.run()),
+        asyncio.create_task(__periodic('orders_compaction', ORDERS_COMPACTION_INTERVAL,
+                                       compact_orders, ORDERS_COMPACTION_BATCH)),
+        asyncio.create_task(__periodic('transactions_partitions', PARTITIONS_MAINTENANCE_INTERVAL,
+                                       maintain_transaction_partitions)),
+    ]
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,76 @@
+"""Стоимость сериализации одной строки для списочных эндпоинтов.
+
+    cd app && python -m benchmarks.serialization --rows 20000
+
+Сравнивает прежний путь (dict + jsonable_encoder + json.dumps, как делал FastAPI по умолчанию)
+с кэшированными представлениями из core/wire.py - холодным и прогретым кэшем.
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+os.environ.setdefault('BASE_INSTRUMENT_TICKER', 'RUB')
+os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite://')
+
+from fastapi.encoders import jsonable_encoder
+
+from core.wire import order_dict, order_wire, trade_dict, trade_wire, wire_list, ORDERS_WIRE, TRADES_WIRE
+from database.models import Order, Transaction, DirectionEnum, OrderStatusEnum
+
+
+def __make_rows(n: int):
+    now = datetime.utcnow()
+    orders = [
+        Order(id=uuid.uuid4(), user_id=uuid.uuid4(), instrument_ticker='MEMECOIN', amount=i % 17, filled=i % 5,
+              price=100 + i % 50, direction=DirectionEnum.BID if i % 2 else DirectionEnum.ASK,
+              status=OrderStatusEnum.NEW, created_at=now - timedelta(seconds=i))
+        for i in range(n)
+    ]
+    trades = [
+        Transaction(id=uuid.uuid4(), instrument_ticker='MEMECOIN', amount=1 + i % 9, price=100 + i % 50,
+                    timestamp=now - timedelta(seconds=i))
+        for i in range(n)
+    ]
+    return orders, trades
+
+
+def __measure(name: str, rows: int, func, repeat: int = 3) -> None:
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:<28} {best * 1e9 / rows:10.0f} ns/row')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+    orders, trades = __make_rows(args.rows)
+
+    __measure('orders: jsonable_encoder', args.rows,
+              lambda: json.dumps(jsonable_encoder([order_dict(o) for o in orders])).encode())
+
+    def cold_orders():
+        ORDERS_WIRE.clear()
+        wire_list(order_wire(o) for o in orders).body
+    __measure('orders: wire (cold)', args.rows, cold_orders)
+    __measure('orders: wire (cached)', args.rows, lambda: wire_list(order_wire(o) for o in orders).body)
+
+    __measure('trades: jsonable_encoder', args.rows,
+              lambda: json.dumps(jsonable_encoder([trade_dict(t) for t in trades])).encode())
+
+    def cold_trades():
+        TRADES_WIRE.clear()
+        wire_list(trade_wire(t) for t in trades).body
+    __measure('trades: wire (cold)', args.rows, cold_trades)
+    __measure('trades: wire (cached)', args.rows, lambda: wire_list(trade_wire(t) for t in trades).body)
+
+
+if __name__ == '__main__':
+    main()
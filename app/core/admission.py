@@ -0,0 +1,121 @@
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable, Tuple
+
+from fastapi import HTTPException
+
+from core import metrics
+
+
+def _parse_limit(value: str) -> Tuple[float, float]:
+    # Формат "rate/burst": rate токенов в секунду, burst - емкость ведра
+    rate, burst = value.split('/')
+    return float(rate), float(burst)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now: float) -> float:
+        """Берет токен. Возвращает 0, если получилось, иначе через сколько секунд появится токен."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class RateLimiter:
+    def __init__(self, name: str, rate: float, burst: float, max_keys: int = 100_000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: Dict[Hashable, TokenBucket] = dict()
+
+    def check(self, key: Hashable) -> float:
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._evict_idle(now)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket.try_acquire(now)
+
+    def _evict_idle(self, now: float) -> None:
+        # Ведро, которое успело наполниться, ничем не отличается от нового
+        idle = [k for k, b in self.buckets.items()
+                if b.tokens + (now - b.updated) * b.rate >= b.burst]
+        for k in idle:
+            del self.buckets[k]
+
+
+class TickerGate:
+    """Ограничивает число заявок, ожидающих матчинга по одному тикеру."""
+
+    def __init__(self, max_pending: int, retry_after: int):
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.pending: Dict[str, int] = dict()
+
+    @asynccontextmanager
+    async def admit(self, ticker: str):
+        pending = self.pending.get(ticker, 0)
+        if pending >= self.max_pending:
+            metrics.inc(f'admission.shed.{ticker}')
+            raise HTTPException(
+                status_code=503,
+                detail='Too many pending orders for ticker',
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        self.pending[ticker] = pending + 1
+        metrics.set_gauge(f'admission.pending.{ticker}', pending + 1)
+        try:
+            yield
+        finally:
+            left = self.pending[ticker] - 1
+            if left:
+                self.pending[ticker] = left
+            else:
+                self.pending.pop(ticker)
+            metrics.set_gauge(f'admission.pending.{ticker}', left)
+
+
+LIMITERS: Dict[str, RateLimiter] = {
+    'order': RateLimiter('order', *_parse_limit(os.getenv('RATE_LIMIT_ORDER', '20/40'))),
+    'read': RateLimiter('read', *_parse_limit(os.getenv('RATE_LIMIT_READ', '50/100'))),
+}
+
+TICKER_GATE = TickerGate(
+    max_pending=int(os.getenv('TICKER_MAX_PENDING', '64')),
+    retry_after=int(os.getenv('TICKER_RETRY_AFTER', '1')),
+)
+
+
+def check_rate(endpoint_class: str, key: Hashable) -> None:
+    limiter = LIMITERS[endpoint_class]
+    wait = limiter.check(key)
+    if wait:
+        metrics.inc(f'admission.rate_limited.{endpoint_class}')
+        raise HTTPException(
+            status_code=429,
+            detail='Rate limit exceeded',
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+    metrics.inc(f'admission.accepted.{endpoint_class}')
+
+
+def limits_config() -> dict:
+    return {
+        "limits": {n: {"rate": l.rate, "burst": l.burst} for n, l in LIMITERS.items()},
+        "ticker_max_pending": TICKER_GATE.max_pending,
+    }
@@ -0,0 +1,80 @@
+import json
+import os
+import zipfile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+# Простой колоночный формат: zip-архив (deflate), в котором каждая колонка каждой
+# группы строк лежит отдельным JSON-массивом, а meta.json описывает схему.
+# Чтение фильтра по паре колонок не требует распаковки остальных.
+
+ROW_GROUP_SIZE = 100_000
+
+
+class ColumnarWriter:
+    """Пишет архив по группам строк: в памяти держится только текущая группа."""
+
+    def __init__(self, path: str, columns: Sequence[str]):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.columns = list(columns)
+        self.total = 0
+        self.groups = 0
+        self.zf = zipfile.ZipFile(self.tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+
+    def write_group(self, rows: Sequence[Sequence]) -> None:
+        if not rows:
+            return
+        for i, name in enumerate(self.columns):
+            self.zf.writestr(f'{self.groups}/{name}.json', json.dumps([r[i] for r in rows], default=str))
+        self.groups += 1
+        self.total += len(rows)
+
+    def close(self) -> int:
+        self.zf.writestr('meta.json', json.dumps({"columns": self.columns, "rows": self.total, "groups": self.groups}))
+        self.zf.close()
+        with open(self.tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(self.tmp_path, self.path)
+        return self.total
+
+    def abort(self) -> None:
+        self.zf.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def write_columnar(path: str, columns: Sequence[str], rows: Iterable[Sequence]) -> int:
+    writer = ColumnarWriter(path, columns)
+    try:
+        buffer: List[Sequence] = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= ROW_GROUP_SIZE:
+                writer.write_group(buffer)
+                buffer = []
+        writer.write_group(buffer)
+        return writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def read_columnar(path: str, columns: Optional[Sequence[str]] = None,
+                  where: Optional[Dict[str, Callable]] = None) -> Iterator[dict]:
+    with zipfile.ZipFile(path) as zf:
+        meta = json.loads(zf.read('meta.json'))
+        columns = list(columns or meta['columns'])
+        where = where or dict()
+        for group in range(meta['groups']):
+            mask = None
+            for name, predicate in where.items():
+                values = json.loads(zf.read(f'{group}/{name}.json'))
+                current = [predicate(v) for v in values]
+                mask = current if mask is None else [a and b for a, b in zip(mask, current)]
+            if mask is not None and not any(mask):
+                continue
+            data = {name: json.loads(zf.read(f'{group}/{name}.json')) for name in columns}
+            size = len(next(iter(data.values()))) if data else 0
+            for i in range(size):
+                if mask is None or mask[i]:
+                    yield {name: data[name][i] for name in columns}
@@ -0,0 +1,123 @@
+from collections import defaultdict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# Агрегированный стакан по уровням цен, который ведется из событий коммита ордеров.
+# Объем и стоимость уровней лежат в дереве Фенвика над всем диапазоном цен BIGINT: узлы
+# хранятся в словаре, поэтому изменение уровня и котировка - это O(log U) обращений
+# без перестроений, независимо от того, сколько уровней в стакане и как часто они меняются.
+PRICE_BITS = 63
+TREE_SIZE = 1 << PRICE_BITS
+
+
+class Quote(NamedTuple):
+    qty: int
+    filled: int
+    cost: int
+    worst_price: Optional[int]
+
+    @property
+    def shortfall(self) -> int:
+        return self.qty - self.filled
+
+
+class SideLevels:
+    def __init__(self, descending: bool):
+        self.descending = descending
+        self.levels: Dict[int, int] = {}
+        # Узлы дерева Фенвика: позиция -> объем и стоимость ее отрезка; нулевые не хранятся
+        self.tree_qty: Dict[int, int] = {}
+        self.tree_cost: Dict[int, int] = {}
+        self.total_qty = 0
+        self.total_cost = 0
+
+    def __position(self, price: int) -> int:
+        # Позиции 1..TREE_SIZE в порядке прохода стакана: для бидов лучшая цена - наибольшая
+        return TREE_SIZE - price if self.descending else price + 1
+
+    def __price(self, position: int) -> int:
+        return TREE_SIZE - position if self.descending else position - 1
+
+    def apply(self, price: int, delta: int) -> None:
+        old = self.levels.get(price, 0)
+        qty = max(old + delta, 0)
+        if qty:
+            self.levels[price] = qty
+        else:
+            self.levels.pop(price, None)
+        delta = qty - old
+        if not delta:
+            return
+        cost = delta * price
+        self.total_qty += delta
+        self.total_cost += cost
+        tree_qty, tree_cost = self.tree_qty, self.tree_cost
+        position = self.__position(price)
+        while position <= TREE_SIZE:
+            left_qty = tree_qty.get(position, 0) + delta
+            if left_qty:
+                tree_qty[position] = left_qty
+                tree_cost[position] = tree_cost.get(position, 0) + cost
+            else:
+                # Пустые узлы не копятся: стоимость без объема тоже нулевая
+                tree_qty.pop(position, None)
+                tree_cost.pop(position, None)
+            position += position & -position
+
+    def __search(self, qty: int) -> Tuple[int, int, int]:
+        # Спуск по дереву: последняя позиция с накопленным объемом меньше qty
+        # и накопленные до нее объем и стоимость
+        position = 0
+        before_qty = before_cost = 0
+        step = TREE_SIZE
+        tree_qty, tree_cost = self.tree_qty, self.tree_cost
+        while step:
+            node = position + step
+            node_qty = tree_qty.get(node, 0)
+            if before_qty + node_qty < qty:
+                position = node
+                before_qty += node_qty
+                before_cost += tree_cost.get(node, 0)
+            step >>= 1
+        return position, before_qty, before_cost
+
+    def quote(self, qty: int) -> Quote:
+        if not self.total_qty:
+            return Quote(qty, 0, 0, None)
+        if qty >= self.total_qty:
+            # Весь объем стороны: худшая цена - уровень, на котором набирается total_qty
+            position, _, _ = self.__search(self.total_qty)
+            return Quote(qty, self.total_qty, self.total_cost, self.__price(position + 1))
+        position, before_qty, before_cost = self.__search(qty)
+        price = self.__price(position + 1)
+        return Quote(qty, qty, before_cost + (qty - before_qty) * price, price)
+
+
+class TickerDepth:
+    def __init__(self):
+        self.bids = SideLevels(descending=True)
+        self.asks = SideLevels(descending=False)
+
+    def side(self, is_bid: bool) -> SideLevels:
+        return self.bids if is_bid else self.asks
+
+
+class DepthBook:
+    def __init__(self):
+        self.tickers: Dict[str, TickerDepth] = defaultdict(TickerDepth)
+
+    def apply(self, ticker: str, is_bid: bool, price: int, delta: int) -> None:
+        if delta:
+            self.tickers[ticker].side(is_bid).apply(price, delta)
+
+    def quote(self, ticker: str, is_buy: bool, qty: int) -> Quote:
+        depth = self.tickers.get(ticker)
+        if depth is None:
+            return Quote(qty, 0, 0, None)
+        # Покупка забирает аски, продажа - биды
+        return depth.side(not is_buy).quote(qty)
+
+    def clear(self, ticker: Optional[str] = None) -> None:
+        if ticker is None:
+            self.tickers.clear()
+        else:
+            self.tickers.pop(ticker, None)
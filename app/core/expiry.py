@@ -0,0 +1,65 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Tuple
+from uuid import UUID
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """Куча (expires_at, seq, order_id, ticker): спим ровно до ближайшего дедлайна
+    и снимаем все просроченные ордера пачкой по тикеру, без опроса таблицы orders."""
+
+    def __init__(self, on_expire: Callable[[str, List[UUID]], Awaitable[None]], batch_size: int = 500):
+        self.on_expire = on_expire
+        self.batch_size = batch_size
+        self.heap: List[Tuple[datetime, int, UUID, str]] = []
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, order_id: UUID, ticker: str, expires_at: datetime) -> None:
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (expires_at, next(self.seq), order_id, ticker))
+        if earliest is None or expires_at < earliest:
+            self.wakeup.set()
+
+    def clear(self) -> None:
+        self.heap.clear()
+        self.wakeup.set()
+
+    def __pop_due(self, now: datetime) -> Dict[str, List[UUID]]:
+        due = defaultdict(list)
+        count = 0
+        while self.heap and self.heap[0][0] <= now and count < self.batch_size:
+            _, _, order_id, ticker = heapq.heappop(self.heap)
+            due[ticker].append(order_id)
+            count += 1
+        return due
+
+    async def run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = (self.heap[0][0] - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for ticker, ids in self.__pop_due(datetime.utcnow()).items():
+                try:
+                    await self.on_expire(ticker, ids)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('failed to expire %s orders of %s', len(ids), ticker)
+                    retry_at = datetime.utcnow() + timedelta(seconds=1)
+                    for order_id in ids:
+                        self.schedule(order_id, ticker, retry_at)
@@ -0,0 +1,51 @@
+import asyncio
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable
+
+# Повторы ордеров по client_order_id. Кэш держит только недавние ответы: повтор обычно
+# приходит сразу после таймаута клиента, более старые находятся по уникальному ключу в базе.
+CLIENT_ORDER_CACHE_SIZE = int(os.getenv('CLIENT_ORDER_CACHE_SIZE', '10000'))
+
+
+class ClientOrders:
+    def __init__(self, maxsize: int = CLIENT_ORDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        # (user_id, client_order_id) -> ордер в том виде, в каком его вернуло создание
+        self.orders: OrderedDict = OrderedDict()
+        # (user_id, client_order_id) -> [блокировка, число ожидающих]
+        self.locks: Dict[Hashable, list] = {}
+
+    def get(self, key: Hashable):
+        order = self.orders.get(key)
+        if order is not None:
+            self.orders.move_to_end(key)
+        return order
+
+    def put(self, key: Hashable, order) -> None:
+        self.orders[key] = order
+        self.orders.move_to_end(key)
+        if len(self.orders) > self.maxsize:
+            self.orders.popitem(last=False)
+
+    @asynccontextmanager
+    async def lock(self, key: Hashable) -> AsyncIterator[None]:
+        # Одновременные запросы с одним ключом проходят по одному: второй видит ордер первого
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    def clear(self) -> None:
+        self.orders.clear()
+
+
+CLIENT_ORDERS = ClientOrders()
@@ -0,0 +1,20 @@
+from collections import defaultdict
+from typing import Dict
+
+COUNTERS: Dict[str, int] = defaultdict(int)
+GAUGES: Dict[str, float] = dict()
+
+
+def inc(name: str, value: int = 1) -> None:
+    COUNTERS[name] += value
+
+
+def set_gauge(name: str, value: float) -> None:
+    GAUGES[name] = value
+
+
+def snapshot() -> dict:
+    return {
+        "counters": dict(COUNTERS),
+        "gauges": dict(GAUGES),
+    }
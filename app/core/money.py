@@ -0,0 +1,52 @@
+import os
+from decimal import Decimal, InvalidOperation
+from typing import Annotated, Union
+
+from pydantic import BeforeValidator, PlainSerializer
+
+# Денежные суммы (баланс в базовой валюте, цены) хранятся целыми числами в минимальных
+# единицах: 1 единица API = MONEY_SCALE минимальных. Количества инструментов - целые лоты.
+MONEY_DECIMALS = int(os.getenv('MONEY_DECIMALS', '0'))
+MONEY_SCALE = 10 ** MONEY_DECIMALS
+
+
+def to_minor(value: Union[int, str, Decimal]) -> int:
+    if isinstance(value, bool):
+        raise ValueError('Money must be a number')
+    if isinstance(value, int):
+        return value * MONEY_SCALE
+    try:
+        minor = Decimal(str(value)) * MONEY_SCALE
+    except InvalidOperation:
+        raise ValueError('Money must be a number')
+    if minor != minor.to_integral_value():
+        raise ValueError(f'Money supports at most {MONEY_DECIMALS} decimal places')
+    return int(minor)
+
+
+def to_major(minor: int) -> Union[int, Decimal]:
+    if MONEY_SCALE == 1:
+        return minor
+    return Decimal(minor) / MONEY_SCALE
+
+
+def to_quantity(value: Union[int, str, Decimal]) -> int:
+    if isinstance(value, bool):
+        raise ValueError('Quantity must be an integer')
+    quantity = Decimal(str(value))
+    if quantity != quantity.to_integral_value():
+        raise ValueError('Quantity must be an integer')
+    return int(quantity)
+
+
+def notional(qty: int, price: int) -> int:
+    return qty * price
+
+
+def average_price(cost: int, qty: int) -> Decimal:
+    # Средняя цена в единицах API с запасом знаков сверх MONEY_DECIMALS
+    return round(Decimal(cost) / (qty * MONEY_SCALE), MONEY_DECIMALS + 4)
+
+
+# Тип для pydantic-схем: на входе единицы API, внутри - минимальные единицы
+Money = Annotated[int, BeforeValidator(to_minor), PlainSerializer(to_major)]
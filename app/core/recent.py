@@ -0,0 +1,68 @@
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+# Последние RECENT_TRADES_DEPTH сделок каждого тикера, от старых к новым. Если кольцо еще
+# ни разу не переполнялось, в нем все сделки тикера, и отвечать можно на любой limit.
+RECENT_TRADES_DEPTH = int(os.getenv('RECENT_TRADES_DEPTH', '200'))
+
+
+class TradeRing:
+    def __init__(self, depth: int, complete: bool):
+        self.trades: Deque = deque(maxlen=depth)
+        self.complete = complete
+
+    def append(self, trade) -> None:
+        trades = self.trades
+        if len(trades) == trades.maxlen:
+            self.complete = False
+        if not trades or trades[-1].timestamp <= trade.timestamp:
+            trades.append(trade)
+            return
+        # Коммиты по одному тикеру могут прийти не в порядке времени сделок
+        if len(trades) == trades.maxlen:
+            trades.popleft()
+        index = len(trades)
+        while index and trades[index - 1].timestamp > trade.timestamp:
+            index -= 1
+        trades.insert(index, trade)
+
+    def latest(self, limit: int) -> Optional[List]:
+        if limit > len(self.trades) and not self.complete:
+            return None
+        trades = self.trades
+        return [trades[i] for i in range(len(trades) - 1, max(len(trades) - limit, 0) - 1, -1)]
+
+
+class RecentTrades:
+    def __init__(self, depth: int = RECENT_TRADES_DEPTH):
+        self.depth = depth
+        self.tickers: Dict[str, TradeRing] = {}
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.tickers
+
+    def seed(self, ticker: str, trades: List) -> None:
+        """trades - последние сделки тикера от новых к старым, не больше depth."""
+        ring = self.tickers[ticker] = TradeRing(self.depth, complete=len(trades) < self.depth)
+        ring.trades.extend(reversed(trades))
+
+    def append(self, trade) -> None:
+        ring = self.tickers.get(trade.instrument_ticker)
+        if ring is None:
+            # Тикер без сделок на старте: кольцо полное с самой первой сделки
+            ring = self.tickers[trade.instrument_ticker] = TradeRing(self.depth, complete=True)
+        ring.append(trade)
+
+    def latest(self, ticker: str, limit: int) -> Optional[List]:
+        ring = self.tickers.get(ticker)
+        return ring.latest(limit) if ring is not None else None
+
+    def drop(self, ticker: str) -> None:
+        self.tickers.pop(ticker, None)
+
+    def clear(self) -> None:
+        self.tickers.clear()
+
+
+RECENT_TRADES = RecentTrades()
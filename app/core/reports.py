@@ -0,0 +1,144 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Set, Tuple
+from uuid import UUID
+
+from core import metrics
+from core.money import to_major
+from core.wire import wire_dumps
+from database.models import DirectionEnum
+
+# Отчеты об исполнении по пользователю: у каждого своя последовательность seq и кольцевой
+# буфер последних REPORTS_BUFFER отчетов. Переподключившийся клиент передает последний
+# полученный seq и дочитывает пропущенное из буфера; если буфер уже ушел дальше, клиент
+# получает gap и один раз сверяется через REST.
+REPORTS_BUFFER = int(os.getenv('REPORTS_BUFFER', '1000'))
+# Буферы давно не торговавших пользователей вытесняются; такой клиент при resume получит gap
+REPORTS_USERS = int(os.getenv('REPORTS_USERS', '10000'))
+
+
+def __order_fields(order) -> dict:
+    return {
+        "order_id": order.id,
+        "ticker": order.instrument_ticker,
+        "side": "BUY" if order.direction == DirectionEnum.BID else 'SELL',
+        # status None - ордер еще не вставлен, default NEW
+        "status": order.status.value if order.status is not None else 'NEW',
+        "filled": order.filled or 0,
+        "remaining": order.amount
+    }
+
+
+def order_report(order) -> dict:
+    return {
+        "type": "order",
+        **__order_fields(order),
+        "qty": order.amount + (order.filled or 0),
+        "price": to_major(order.price) if order.price is not None else None
+    }
+
+
+def fill_report(order, price: int, qty: int) -> dict:
+    return {
+        "type": "fill",
+        **__order_fields(order),
+        "price": to_major(price),
+        "qty": qty
+    }
+
+
+def balance_report(ticker: str, delta: int, available: int, is_money: bool) -> dict:
+    convert = to_major if is_money else int
+    return {
+        "type": "balance",
+        "ticker": ticker,
+        "delta": convert(delta),
+        "available": convert(available)
+    }
+
+
+class Subscription:
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        # Клиент не успевает читать - отключаем, он переподключится с resume
+        self.lagged = False
+
+    def offer(self, item: Tuple[int, bytes]) -> None:
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+
+class UserReports:
+    def __init__(self, size: int):
+        self.seq = 0
+        self.buffer: Deque[Tuple[int, bytes]] = deque(maxlen=size)
+        self.subscriptions: Set[Subscription] = set()
+
+
+class ExecutionReports:
+    def __init__(self, size: int = REPORTS_BUFFER, max_users: int = REPORTS_USERS):
+        self.size = size
+        self.max_users = max_users
+        self.users: OrderedDict[UUID, UserReports] = OrderedDict()
+
+    def __user(self, user_id: UUID) -> UserReports:
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserReports(self.size)
+            self.__evict()
+        else:
+            self.users.move_to_end(user_id)
+        return user
+
+    def __evict(self) -> None:
+        # Самые давние первыми; пользователей с открытыми подписками не трогаем
+        for _ in range(len(self.users)):
+            if len(self.users) <= self.max_users:
+                return
+            user_id, user = self.users.popitem(last=False)
+            if user.subscriptions:
+                self.users[user_id] = user
+
+    def push(self, user_id: UUID, report: dict) -> None:
+        user = self.__user(user_id)
+        user.seq += 1
+        report['seq'] = user.seq
+        item = (user.seq, wire_dumps(report))
+        user.buffer.append(item)
+        for subscription in user.subscriptions:
+            subscription.offer(item)
+        metrics.inc('reports.pushed')
+
+    def subscribe(self, user_id: UUID, since: Optional[int]) -> Tuple[Subscription, List[bytes], bool]:
+        """Возвращает подписку, пропущенные отчеты после since и признак разрыва."""
+        user = self.__user(user_id)
+        subscription = Subscription(self.size)
+        user.subscriptions.add(subscription)
+        if since is None or since == user.seq:
+            return subscription, [], False
+        oldest = user.buffer[0][0] if user.buffer else user.seq + 1
+        # since впереди seq бывает после перезапуска сервера
+        if since > user.seq or since < oldest - 1:
+            return subscription, [], True
+        return subscription, [wire for seq, wire in user.buffer if seq > since], False
+
+    def unsubscribe(self, user_id: UUID, subscription: Subscription) -> None:
+        user = self.users.get(user_id)
+        if user is not None:
+            user.subscriptions.discard(subscription)
+
+    def drop(self, user_id: UUID) -> None:
+        self.users.pop(user_id, None)
+
+    def current(self, user_id: UUID) -> int:
+        user = self.users.get(user_id)
+        return user.seq if user is not None else 0
+
+    def clear(self) -> None:
+        self.users.clear()
+
+
+REPORTS = ExecutionReports()
@@ -0,0 +1,75 @@
+import heapq
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+# Стоп-заявки одного тикера в двух кучах по цене срабатывания:
+#   buy-стопы срабатывают, когда сделка прошла по цене >= stop_price (min-куча),
+#   sell-стопы - когда по цене <= stop_price (max-куча через отрицание).
+# После сделок снимаются только сработавшие вершины, стоимость не зависит от числа стопов.
+# Порядок внутри одной цены - (created_at, id), он одинаков и после перезапуска.
+
+Entry = Tuple[int, datetime, str, UUID]
+
+
+class TickerStops:
+    def __init__(self):
+        self.buy: List[Entry] = []
+        self.sell: List[Entry] = []
+        self.low: Optional[int] = None
+        self.high: Optional[int] = None
+
+    def observe(self, price: int) -> None:
+        self.low = price if self.low is None else min(self.low, price)
+        self.high = price if self.high is None else max(self.high, price)
+
+    def pop_triggered(self) -> List[UUID]:
+        fired = []
+        if self.high is not None:
+            while self.buy and self.buy[0][0] <= self.high:
+                fired.append(heapq.heappop(self.buy)[3])
+        if self.low is not None:
+            while self.sell and -self.sell[0][0] >= self.low:
+                fired.append(heapq.heappop(self.sell)[3])
+        self.low = self.high = None
+        return fired
+
+
+class StopBook:
+    def __init__(self):
+        self.tickers: Dict[str, TickerStops] = defaultdict(TickerStops)
+        # Отмененные стопы не ищем в куче, а пропускаем при извлечении
+        self.cancelled: set = set()
+
+    def add(self, ticker: str, stop_id: UUID, is_buy: bool, stop_price: int, created_at: datetime) -> None:
+        stops = self.tickers[ticker]
+        if is_buy:
+            heapq.heappush(stops.buy, (stop_price, created_at, str(stop_id), stop_id))
+        else:
+            heapq.heappush(stops.sell, (-stop_price, created_at, str(stop_id), stop_id))
+
+    def cancel(self, stop_id: UUID) -> None:
+        self.cancelled.add(stop_id)
+
+    def observe(self, ticker: str, price: int) -> None:
+        self.tickers[ticker].observe(price)
+
+    def pop_triggered(self, ticker: str) -> List[UUID]:
+        stops = self.tickers.get(ticker)
+        if stops is None:
+            return []
+        fired = []
+        for stop_id in stops.pop_triggered():
+            if stop_id in self.cancelled:
+                self.cancelled.discard(stop_id)
+            else:
+                fired.append(stop_id)
+        return fired
+
+    def clear(self, ticker: Optional[str] = None) -> None:
+        if ticker is None:
+            self.tickers.clear()
+            self.cancelled.clear()
+        else:
+            self.tickers.pop(ticker, None)
@@ -0,0 +1,32 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Optional
+
+# План прохода агрессивной заявки по стакану. На вход - цены и остатки встречных ордеров
+# в порядке очереди исполнения (лучшая цена, затем время). Граница по лимитной цене и
+# число целиком исполняемых ордеров находятся бинарным поиском по ценам и накопленным
+# объемам, поэтому план считается без построчного цикла в Python.
+
+
+def plan_sweep(prices: array, quantities: array, qty: int, limit: Optional[int], ascending: bool) -> array:
+    """Объемы исполнения по каждому ордеру с начала очереди; последний может быть частичным.
+
+    ascending - цены встречной стороны растут (аски под покупку), иначе убывают (биды под продажу).
+    """
+    crossed = len(prices)
+    if limit is not None:
+        if ascending:
+            crossed = bisect_right(prices, limit)
+        else:
+            crossed = bisect_right(prices, -limit, key=lambda price: -price)
+    cumulative = array('q', accumulate(quantities[:crossed]))
+    if not cumulative or qty <= 0:
+        return array('q')
+    full = bisect_left(cumulative, qty)
+    if full == crossed:
+        # Глубины не хватило: встречные ордера исполняются целиком
+        return quantities[:crossed]
+    fills = quantities[:full + 1]
+    fills[full] = qty - (cumulative[full - 1] if full else 0)
+    return fills
@@ -0,0 +1,118 @@
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Скользящая статистика тикеров за 24 часа по минутным корзинам. Сделка обновляет текущую
+# корзину и суммы окна, устаревшие корзины снимаются с головы очереди, а high/low окна
+# держатся в монотонных очередях - все операции амортизированно O(1).
+BUCKET_SECONDS = 60
+WINDOW = timedelta(hours=24)
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_index(timestamp: datetime) -> int:
+    # Время сделок - naive UTC, поэтому считаем от naive EPOCH, а не через .timestamp()
+    return int((timestamp - EPOCH).total_seconds()) // BUCKET_SECONDS
+
+
+class Bucket:
+    __slots__ = ('index', 'volume', 'notional', 'trades')
+
+    def __init__(self, index: int):
+        self.index = index
+        self.volume = 0
+        self.notional = 0
+        self.trades = 0
+
+
+class RollingStats:
+    def __init__(self, window_buckets: int):
+        self.window_buckets = window_buckets
+        self.buckets: Deque[Bucket] = deque()
+        self.highs: Deque[Tuple[int, int]] = deque()
+        self.lows: Deque[Tuple[int, int]] = deque()
+        self.volume = 0
+        self.notional = 0
+        self.trades = 0
+        self.last_price: Optional[int] = None
+
+    def add(self, index: int, price: int, amount: int) -> None:
+        # Запоздавшая сделка относится к текущей корзине, порядок корзин не нарушается
+        if self.buckets and index < self.buckets[-1].index:
+            index = self.buckets[-1].index
+        self.expire(index)
+        if not self.buckets or self.buckets[-1].index != index:
+            self.buckets.append(Bucket(index))
+        bucket = self.buckets[-1]
+        bucket.volume += amount
+        bucket.notional += amount * price
+        bucket.trades += 1
+        self.volume += amount
+        self.notional += amount * price
+        self.trades += 1
+        self.last_price = price
+        self.__push(self.highs, index, price, lambda tail: tail <= price)
+        self.__push(self.lows, index, price, lambda tail: tail >= price)
+
+    @staticmethod
+    def __push(extremes: Deque[Tuple[int, int]], index: int, price: int, dominated) -> None:
+        while extremes and dominated(extremes[-1][1]):
+            extremes.pop()
+        if not extremes or extremes[-1][0] != index:
+            extremes.append((index, price))
+
+    def expire(self, index: int) -> None:
+        cutoff = index - self.window_buckets + 1
+        while self.buckets and self.buckets[0].index < cutoff:
+            bucket = self.buckets.popleft()
+            self.volume -= bucket.volume
+            self.notional -= bucket.notional
+            self.trades -= bucket.trades
+        while self.highs and self.highs[0][0] < cutoff:
+            self.highs.popleft()
+        while self.lows and self.lows[0][0] < cutoff:
+            self.lows.popleft()
+
+    @property
+    def high(self) -> Optional[int]:
+        return self.highs[0][1] if self.highs else None
+
+    @property
+    def low(self) -> Optional[int]:
+        return self.lows[0][1] if self.lows else None
+
+
+class TickerStats:
+    def __init__(self, window: timedelta = WINDOW):
+        self.window_buckets = int(window.total_seconds()) // BUCKET_SECONDS
+        self.tickers: Dict[str, RollingStats] = {}
+
+    def track(self, ticker: str) -> RollingStats:
+        stats = self.tickers.get(ticker)
+        if stats is None:
+            stats = self.tickers[ticker] = RollingStats(self.window_buckets)
+        return stats
+
+    def drop(self, ticker: str) -> None:
+        self.tickers.pop(ticker, None)
+
+    def record(self, ticker: str, price: int, amount: int, timestamp: datetime) -> None:
+        self.track(ticker).add(bucket_index(timestamp), price, amount)
+
+    def last_price(self, ticker: str) -> Optional[int]:
+        stats = self.tickers.get(ticker)
+        return stats.last_price if stats is not None else None
+
+    def snapshot(self, now: Optional[datetime] = None) -> List[Tuple[str, RollingStats]]:
+        index = bucket_index(now or datetime.utcnow())
+        result = []
+        for ticker, stats in self.tickers.items():
+            stats.expire(index)
+            result.append((ticker, stats))
+        return result
+
+    def clear(self) -> None:
+        self.tickers.clear()
+
+
+TICKER_STATS = TickerStats()
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Hashable, Iterable
+
+import orjson
+from fastapi.responses import Response
+
+from core.money import to_major
+from database.models import DirectionEnum
+
+# Готовые JSON-представления ордеров и сделок. Сделка неизменна, ордер меняется только
+# вместе со статусом/исполненным объемом, поэтому эти поля входят в ключ кэша.
+WIRE_CACHE_SIZE = 200_000
+
+
+class WireCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.items: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable):
+        value = self.items.get(key)
+        if value is not None:
+            self.items.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: bytes) -> bytes:
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self.items.clear()
+
+
+ORDERS_WIRE = WireCache(WIRE_CACHE_SIZE)
+TRADES_WIRE = WireCache(WIRE_CACHE_SIZE)
+
+
+def __default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+
+def wire_dumps(value) -> bytes:
+    return orjson.dumps(value, default=__default)
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def order_dict(order) -> dict:
+    return {
+        "id": order.id,
+        "status": order.status.value,
+        "user_id": order.user_id,
+        "timestamp": format_timestamp(order.created_at),
+        "body": {
+            "direction": "BUY" if order.direction == DirectionEnum.BID else 'SELL',
+            "ticker": order.instrument_ticker,
+            "qty": order.amount + order.filled,
+            "price": to_major(order.price) if order.price is not None else None
+        },
+        "filled": order.filled
+    }
+
+
+def stop_dict(stop) -> dict:
+    return {
+        "id": stop.id,
+        "status": stop.status.value,
+        "user_id": stop.user_id,
+        "timestamp": format_timestamp(stop.created_at),
+        "body": {
+            "direction": "BUY" if stop.direction == DirectionEnum.BID else 'SELL',
+            "ticker": stop.instrument_ticker,
+            "qty": stop.amount,
+            "price": to_major(stop.price) if stop.price is not None else None,
+            "stop_price": to_major(stop.stop_price)
+        },
+        "order_id": stop.order_id
+    }
+
+
+def trade_dict(trade) -> dict:
+    return {
+        "ticker": trade.instrument_ticker,
+        "amount": trade.amount,
+        "price": to_major(trade.price),
+        "timestamp": format_timestamp(trade.timestamp)
+    }
+
+
+def order_wire(order) -> bytes:
+    key = (order.id, order.status, order.filled, order.amount, order.price)
+    wire = ORDERS_WIRE.get(key)
+    if wire is None:
+        wire = ORDERS_WIRE.put(key, orjson.dumps(order_dict(order), default=__default))
+    return wire
+
+
+def trade_wire(trade) -> bytes:
+    wire = TRADES_WIRE.get(trade.id)
+    if wire is None:
+        wire = TRADES_WIRE.put(trade.id, orjson.dumps(trade_dict(trade), default=__default))
+    return wire
+
+
+def stop_wire(stop) -> bytes:
+    # Стоп-заявок немного и они меняются целиком, кэш не нужен
+    return orjson.dumps(stop_dict(stop), default=__default)
+
+
+class WireResponse(Response):
+    """Отдает уже сериализованные фрагменты без jsonable_encoder: bytes или список bytes."""
+    media_type = 'application/json'
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return b'[' + b','.join(content) + b']'
+
+
+def wire_list(items: Iterable[bytes]) -> WireResponse:
+    return WireResponse(list(items))
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from core import metrics
+from crud.events import subscribe
+from database.database import engine, is_postgres
+
+logger = logging.getLogger(__name__)
+
+# Шина между экземплярами приложения через LISTEN/NOTIFY. Два вида сообщений:
+# - инвалидация: CRUD публикует ('invalidate', (kind, key, local)) в сессии, после commit
+#   остальные узлы перечитывают затронутое из базы. Несколько событий по одному ключу
+#   схлопываются в одну перезагрузку;
+# - дельта: send(kind, data) - готовое изменение (уровень стакана, сделка), которое
+#   остальные узлы применяют к своим кэшам без похода в базу.
+# Версии монотонны в пределах узла-источника. Повтор отбрасывается, пропуск версии (потерянное
+# уведомление) и переподключение означают, что дельты могли потеряться, - тогда RESYNC.
+BUS_CHANNEL = os.getenv('BUS_CHANNEL', 'market_invalidation')
+BUS_RECONNECT_DELAY = float(os.getenv('BUS_RECONNECT_DELAY', '1'))
+# Лимит NOTIFY - 8000 байт, несколько сообщений упаковываются в одно уведомление
+BUS_PAYLOAD_LIMIT = 7000
+# Служебный вид события: после переподключения узел мог пропустить уведомления
+RESYNC = 'resync'
+
+Handler = Callable[[Optional[str]], Awaitable[None]]
+DeltaHandler = Callable[[Any], None]
+
+
+class InvalidationBus:
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.version = 0
+        self.seen: Dict[str, int] = {}
+        self.handlers: Dict[str, List[Handler]] = defaultdict(list)
+        self.delta_handlers: Dict[str, List[DeltaHandler]] = defaultdict(list)
+        self.outbox: Optional[asyncio.Queue] = None
+        self.carry: Optional[tuple] = None
+        # Еще не отправленные ключи: пачка изменений одного стакана уходит одним уведомлением
+        self.pending: Set[Tuple[str, Optional[str]]] = set()
+        self.running: Set[Tuple[str, Optional[str]]] = set()
+        self.dirty: Set[Tuple[str, Optional[str]]] = set()
+
+    def on(self, kind: str, handler: Handler) -> None:
+        self.handlers[kind].append(handler)
+
+    def on_delta(self, kind: str, handler: DeltaHandler) -> None:
+        self.delta_handlers[kind].append(handler)
+
+    def emit(self, kind: str, key: Optional[str], local: bool = False) -> None:
+        # local - применить и на своем узле, если его кэш не обновляется событиями коммита
+        if local:
+            self.__dispatch(kind, key)
+        item = (kind, key)
+        if self.outbox is None or item in self.pending:
+            return
+        self.pending.add(item)
+        self.outbox.put_nowait((kind, key, None))
+
+    def send(self, kind: str, data: Any) -> None:
+        # Дельты не схлопываются: каждая применяется на других узлах ровно один раз
+        if self.outbox is not None:
+            self.outbox.put_nowait((kind, None, data))
+
+    def __on_notify(self, connection, pid, channel, payload) -> None:
+        try:
+            event = json.loads(payload)
+            origin, version, messages = event['o'], event['v'], event['m']
+        except (ValueError, KeyError):
+            logger.warning('malformed invalidation %r', payload)
+            return
+        if origin == self.origin or version <= self.seen.get(origin, 0):
+            return
+        if origin in self.seen and version != self.seen[origin] + 1:
+            # Уведомление узла-источника потерялось вместе с его дельтами
+            metrics.inc('bus.gaps')
+            self.__dispatch(RESYNC, None)
+        self.seen[origin] = version
+        metrics.inc('bus.received')
+        for kind, key, data in messages:
+            if data is None:
+                self.__dispatch(kind, key)
+                continue
+            for handler in self.delta_handlers[kind]:
+                try:
+                    handler(data)
+                except Exception:
+                    logger.exception('delta handler for %s failed', kind)
+
+    def __dispatch(self, kind: str, key: Optional[str]) -> None:
+        item = (kind, key)
+        if item in self.running:
+            self.dirty.add(item)
+            return
+        self.running.add(item)
+        asyncio.get_running_loop().create_task(self.__apply(item))
+
+    async def __apply(self, item: Tuple[str, Optional[str]]) -> None:
+        kind, key = item
+        try:
+            while True:
+                self.dirty.discard(item)
+                for handler in self.handlers[kind]:
+                    try:
+                        await handler(key)
+                    except Exception:
+                        logger.exception('invalidation handler for %s %s failed', kind, key)
+                if item not in self.dirty:
+                    return
+        finally:
+            self.running.discard(item)
+
+    def __batch(self, first: tuple) -> List[list]:
+        # Забираем из очереди все, что влезает в одно уведомление
+        messages = [list(first)]
+        size = len(json.dumps(first))
+        while not self.outbox.empty():
+            item = self.outbox.get_nowait()
+            item_size = len(json.dumps(item)) + 1
+            if size + item_size > BUS_PAYLOAD_LIMIT:
+                # Не влезло - уйдет первым в следующем уведомлении
+                self.carry = item
+                break
+            messages.append(list(item))
+            size += item_size
+        for kind, key, data in messages:
+            if data is None:
+                self.pending.discard((kind, key))
+        return messages
+
+    async def run(self) -> None:
+        if not is_postgres():
+            return
+        dsn = engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+        self.outbox = asyncio.Queue()
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                await connection.add_listener(BUS_CHANNEL, self.__on_notify)
+                # Все, что пришло до подписки (в том числе между загрузкой кэшей на старте
+                # и первым подключением), прошло мимо - перечитываем
+                self.__dispatch(RESYNC, None)
+                while True:
+                    first, self.carry = self.carry, None
+                    messages = self.__batch(first or await self.outbox.get())
+                    self.version += 1
+                    payload = json.dumps({"o": self.origin, "v": self.version, "m": messages})
+                    try:
+                        await connection.execute('SELECT pg_notify($1, $2)', BUS_CHANNEL, payload)
+                    except Exception:
+                        # Не отправленное уйдет после переподключения
+                        for kind, key, data in messages:
+                            self.outbox.put_nowait((kind, key, data))
+                        raise
+                    metrics.inc('bus.sent')
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('invalidation bus connection lost')
+                await asyncio.sleep(BUS_RECONNECT_DELAY)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+
+BUS = InvalidationBus()
+subscribe('invalidate', lambda event: BUS.emit(*event))
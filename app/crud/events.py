@@ -0,0 +1,38 @@
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# События копятся в session.info и раздаются подписчикам только после успешного commit,
+# так что in-memory структуры (стаканы, кэши, стопы) никогда не видят откаченных сделок.
+HANDLERS: Dict[str, List[Callable[[Any], None]]] = defaultdict(list)
+
+
+def subscribe(kind: str, handler: Callable[[Any], None]) -> None:
+    HANDLERS[kind].append(handler)
+
+
+def publish(session, kind: str, payload: Any) -> None:
+    session.info.setdefault('events', []).append((kind, payload))
+
+
+@event.listens_for(Session, 'after_commit')
+def __after_commit(session):
+    events = session.info.pop('events', None)
+    if not events:
+        return
+    for kind, payload in events:
+        for handler in HANDLERS[kind]:
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception('event handler for %s failed', kind)
+
+
+@event.listens_for(Session, 'after_rollback')
+def __after_rollback(session):
+    session.info.pop('events', None)
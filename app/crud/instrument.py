@@ -3,8 +3,11 @@ from typing import Optional
 
 from fastapi import HTTPException
 
-from sqlalchemy import select
+from sqlalchemy import select, delete
 
+from core.recent import RECENT_TRADES
+from core.tickerstats import TICKER_STATS
+from crud.events import publish
 from crud.locks import LOCKS, acquire_locks
 from database.database import async_session_maker
 from database.models import Instrument, User, UserInventory
@@ -19,11 +22,16 @@ async def create_instrument(name: str, ticker: str) -> Instrument:
         users = result.scalars().all()
 
         for user in users:
-            inv = UserInventory(user=user, instrument=new_instrument, quantity=0.0)
+            inv = UserInventory(user=user, instrument=new_instrument, quantity=0)
             session.add(inv)
 
+        # Стакан и стопы тикера могли остаться от удаленного инструмента с тем же тикером
+        publish(session, 'instrument', ticker)
+        publish(session, 'invalidate', ('instrument', ticker, True))
         await session.commit()
         await session.refresh(new_instrument)
+        TICKER_STATS.track(ticker)
+        RECENT_TRADES.seed(ticker, [])
         return new_instrument
 
 async def get_instrument_by_ticker(ticker: str) -> Optional[Instrument]:
@@ -44,14 +52,30 @@ async def delete_instrument(ticker: str) -> Instrument:
             if not instrument:
                 raise HTTPException(status_code=404, detail='Инструмент с данным ticker е найден')
             await session.delete(instrument)
+            # Ордера уходят каскадом базы, мимо событий стакана
+            publish(session, 'instrument', ticker)
+            publish(session, 'invalidate', ('instrument', ticker, True))
             await session.commit()
+            TICKER_STATS.drop(ticker)
+            RECENT_TRADES.drop(ticker)
             return instrument
     LOCKS.pop(ticker)
 
 async def delete_all_instruments() -> None:
-    instruments = await get_all_instruments()
-    for i in instruments:
-        await delete_instrument(i.ticker)
+    # Один DELETE: остатки и ордера уходят ON DELETE CASCADE, стаканы и стопы
+    # перечитываются обработчиком инвалидации и на этом узле
+    async with acquire_locks(*LOCKS.values()):
+        async with async_session_maker() as session:
+            result = await session.execute(delete(Instrument).returning(Instrument.ticker))
+            tickers = result.scalars().all()
+            for ticker in tickers:
+                publish(session, 'instrument', ticker)
+                publish(session, 'invalidate', ('instrument', ticker, True))
+            await session.commit()
+    for ticker in tickers:
+        TICKER_STATS.drop(ticker)
+        RECENT_TRADES.drop(ticker)
+        LOCKS.pop(ticker, None)
 
 
 async def get_all_instruments() -> list[Instrument]:
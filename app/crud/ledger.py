@@ -0,0 +1,90 @@
+import asyncio
+import os
+import random
+from typing import List, Tuple
+from uuid import UUID
+
+from sqlalchemy import update
+from sqlalchemy.exc import DBAPIError
+
+from core import metrics
+from core.reports import balance_report
+from crud.events import publish
+from database.models import User, UserInventory
+
+# Балансы меняются только атомарным UPDATE ... WHERE balance + d >= 0 RETURNING,
+# без чтения строки в ORM. Параллельный матчинг по разным тикерам не теряет обновлений
+# даже когда трогает один и тот же счет, и не нуждается в глобальной блокировке.
+
+RUB = os.getenv('BASE_INSTRUMENT_TICKER')
+LEDGER_RETRIES = int(os.getenv('LEDGER_RETRIES', '5'))
+# serialization_failure, deadlock_detected
+RETRYABLE_SQLSTATES = {'40001', '40P01'}
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+async def adjust_balance(session, user_id: UUID, delta: int) -> int:
+    q = (
+        update(User)
+        .where(User.id == user_id, User.balance + delta >= 0)
+        .values(balance=User.balance + delta)
+        .returning(User.balance)
+        .execution_options(synchronize_session=False)
+    )
+    row = (await session.execute(q)).first()
+    if row is None:
+        raise InsufficientFunds('Not enough balance')
+    publish(session, 'report', (user_id, balance_report(RUB, delta, row[0], True)))
+    return row[0]
+
+
+async def adjust_inventory(session, user_id: UUID, ticker: str, delta: int) -> int:
+    q = (
+        update(UserInventory)
+        .where(UserInventory.user_id == user_id, UserInventory.instrument_ticker == ticker,
+               UserInventory.quantity + delta >= 0)
+        .values(quantity=UserInventory.quantity + delta)
+        .returning(UserInventory.quantity)
+        .execution_options(synchronize_session=False)
+    )
+    row = (await session.execute(q)).first()
+    if row is None:
+        raise InsufficientFunds('Not enough instruments')
+    publish(session, 'report', (user_id, balance_report(ticker, delta, row[0], False)))
+    return row[0]
+
+
+async def adjust_balances(session, deltas: List[Tuple[UUID, int]]) -> None:
+    # Одинаковый порядок строк во всех транзакциях снижает вероятность взаимных блокировок.
+    # Для одного счета списание идет раньше зачисления, чтобы проверка видела свободный остаток.
+    for user_id, delta in sorted(deltas, key=lambda d: (str(d[0]), d[1])):
+        if delta:
+            await adjust_balance(session, user_id, delta)
+
+
+async def adjust_inventories(session, deltas: List[Tuple[UUID, str, int]]) -> None:
+    for user_id, ticker, delta in sorted(deltas, key=lambda d: (str(d[0]), d[1], d[2])):
+        if delta:
+            await adjust_inventory(session, user_id, ticker, delta)
+
+
+def is_retryable(e: Exception) -> bool:
+    if not isinstance(e, DBAPIError):
+        return False
+    orig = e.orig
+    sqlstate = getattr(orig, 'sqlstate', None) or getattr(orig, 'pgcode', None)
+    return sqlstate in RETRYABLE_SQLSTATES or 'database is locked' in str(orig)
+
+
+async def run_with_retry(func, *args, attempts: int = LEDGER_RETRIES):
+    for attempt in range(attempts):
+        try:
+            return await func(*args)
+        except DBAPIError as e:
+            if not is_retryable(e) or attempt == attempts - 1:
+                raise
+            metrics.inc('ledger.retries')
+            await asyncio.sleep(random.uniform(0, 0.005 * 2 ** attempt))
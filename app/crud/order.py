@@ -1,32 +1,64 @@
 import asyncio
+import logging
 import os
+import uuid
+from array import array
+from collections import defaultdict
 from uuid import UUID
-from typing import List, Optional
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
 
 from fastapi import HTTPException
-from sqlalchemy import select, asc, desc, delete
+from sqlalchemy import select, asc, desc, delete, insert, update, func, event, inspect, Row
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 
+from core.money import notional
+from crud.ledger import adjust_balances, adjust_inventories, adjust_balance, adjust_inventory, \
+    InsufficientFunds, is_retryable, run_with_retry
 from crud.user import __change_balance
 from crud.locks import LOCKS, acquire_locks
+from crud.bus import BUS, RESYNC
+from crud.instrument import get_all_instruments, get_instrument_by_ticker
+from crud.transaction import get_last_price, stream_transactions, load_recent_trades
 from database.database import async_session_maker
-from database.models import Order, DirectionEnum, User, OrderStatusEnum, Transaction, UserInventory
-
+from core.expiry import ExpiryScheduler
+from core.depth import DepthBook
+from core.idempotency import CLIENT_ORDERS
+from core.recent import RECENT_TRADES
+from core.reports import REPORTS, order_report, fill_report
+from core.stops import StopBook
+from core.sweep import plan_sweep
+from core.tickerstats import TICKER_STATS, WINDOW
+from crud.events import publish, subscribe
+from database.models import Order, DirectionEnum, User, OrderStatusEnum, Transaction, OrderHistory, \
+    TimeInForceEnum, StopOrder, StopStatusEnum
+
+logger = logging.getLogger(__name__)
 
 RUB = os.getenv('BASE_INSTRUMENT_TICKER')
+TERMINAL_STATUSES = [OrderStatusEnum.EXECUTED, OrderStatusEnum.CANCELLED]
+LIVE_STATUSES = [OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]
+HISTORY_COLUMNS = [c.name for c in Order.__table__.columns]
 
 async def delete_all_orders():
     async with async_session_maker() as session:
         await session.execute(delete(Order))
         await session.commit()
+    DEPTH.clear()
 
 
 async def cancel_order(order_id: str, user_id: UUID) -> Optional[Order]:
+    order_id = UUID(str(order_id))
     async with async_session_maker() as session:
         q = select(Order).where(Order.id == order_id, Order.user_id == user_id)
         result = await session.execute(q)
         order: Order = result.scalars().first()
         if not order:
+            q = select(OrderHistory.id).where(OrderHistory.id == order_id, OrderHistory.user_id == user_id)
+            if (await session.execute(q)).first():
+                raise HTTPException(400, 'Order executed/partially_executed/cancelled')
             return None
 
         lock = LOCKS[order.instrument_ticker]
@@ -39,7 +71,7 @@ async def cancel_order(order_id: str, user_id: UUID) -> Optional[Order]:
             if order.direction == DirectionEnum.ASK:
                 await __change_balance(session, order.user_id, order.instrument_ticker, order.amount)
             elif order.direction == DirectionEnum.BID:
-                await __change_balance(session, order.user_id, RUB, order.amount * order.price)
+                await __change_balance(session, order.user_id, RUB, notional(order.amount, order.price))
             order.status = OrderStatusEnum.CANCELLED
             session.add(order)
             await session.flush()
@@ -48,11 +80,136 @@ async def cancel_order(order_id: str, user_id: UUID) -> Optional[Order]:
             return order
 
 
-async def get_order(order_id: str) -> Optional[Order]:
+async def amend_order(order_id: str, user_id: UUID, qty: Optional[int], price: Optional[int]) -> Optional[Order]:
+    order_id = UUID(str(order_id))
+    async with async_session_maker() as session:
+        q = select(Order.instrument_ticker).where(Order.id == order_id, Order.user_id == user_id)
+        ticker = (await session.execute(q)).scalar()
+        if ticker is None:
+            q = select(OrderHistory.id).where(OrderHistory.id == order_id, OrderHistory.user_id == user_id)
+            if (await session.execute(q)).first():
+                raise HTTPException(400, 'Order executed/cancelled')
+            return None
+
+    if ticker not in LOCKS:
+        LOCKS[ticker] = asyncio.Lock()
+    async with acquire_locks(LOCKS[ticker]):
+        order = await run_with_retry(__amend, order_id, qty, price)
+    await trigger_stops(ticker)
+    return order
+
+
+async def __amend(order_id: UUID, qty: Optional[int], price: Optional[int]) -> Order:
+    async with async_session_maker() as session:
+        q = select(Order).where(Order.id == order_id).with_for_update()
+        order: Optional[Order] = (await session.execute(q)).scalars().first()
+        if order is None:
+            # Между поиском тикера и блокировкой ордер ушел в историю или удален вместе с владельцем
+            raise HTTPException(404, 'Order not found')
+        if order.status not in [OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]:
+            raise HTTPException(400, 'Order executed/cancelled')
+        if order.price is None:
+            raise HTTPException(400, 'Order is market')
+
+        # qty - новый полный объем ордера, как в CreateOrderScheme; исполненная часть не меняется
+        new_amount = (qty - order.filled) if qty is not None else order.amount
+        new_price = price if price is not None else order.price
+        if new_amount <= 0:
+            raise HTTPException(400, 'qty must be greater than filled')
+        is_bid = order.direction == DirectionEnum.BID
+        frozen_ticker = RUB if is_bid else order.instrument_ticker
+        old_frozen = notional(order.amount, order.price) if is_bid else order.amount
+        new_frozen = notional(new_amount, new_price) if is_bid else new_amount
+
+        try:
+            if new_price == order.price and new_amount <= order.amount:
+                # Уменьшение объема сохраняет место в очереди, размораживаем только разницу
+                order.amount = new_amount
+                if old_frozen != new_frozen:
+                    await unfreeze_balance(session, order.user_id, frozen_ticker, old_frozen - new_frozen)
+            else:
+                # Новая цена или больший объем - ордер встает в конец очереди своей цены
+                # и, если цена пересекает стакан, сразу матчится как новая заявка
+                order.amount = new_amount
+                order.price = new_price
+                order.created_at = datetime.utcnow()
+                await unfreeze_balance(session, order.user_id, frozen_ticker, old_frozen)
+                await session.flush()
+                if is_bid:
+                    await __match_bid(session, order)
+                else:
+                    await __match_ask(session, order)
+                if order.status != OrderStatusEnum.EXECUTED:
+                    remaining = notional(order.amount, order.price) if is_bid else order.amount
+                    await freeze_balance(session, order.user_id, frozen_ticker, remaining)
+        except HTTPException:
+            raise
+        except Exception as e:
+            if is_retryable(e):
+                raise
+            raise HTTPException(400, str(e))
+
+        await session.commit()
+        return order
+
+
+async def get_order(order_id: str) -> Optional[Order | OrderHistory]:
+    order_id = UUID(str(order_id))
     async with async_session_maker() as session:
         q = select(Order).where(Order.id == order_id)
         result = await session.execute(q)
-        return result.scalars().first()
+        order = result.scalars().first()
+        if order is None:
+            q = select(OrderHistory).where(OrderHistory.id == order_id)
+            order = (await session.execute(q)).scalars().first()
+        return order
+
+
+async def stream_orders(ticker: Optional[str] = None, start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, batch: int = 5000) -> AsyncIterator[Row]:
+    # Живые ордера, затем архивные; колонки одинаковые, так что получатель их не различает
+    async with async_session_maker() as session:
+        for model in (Order, OrderHistory):
+            stmt = select(*[model.__table__.c[c] for c in HISTORY_COLUMNS]).order_by(model.created_at)
+            if ticker:
+                stmt = stmt.where(model.instrument_ticker == ticker)
+            if start:
+                stmt = stmt.where(model.created_at >= start)
+            if end:
+                stmt = stmt.where(model.created_at < end)
+            result = await session.stream(stmt.execution_options(yield_per=batch))
+            async for partition in result.partitions():
+                for row in partition:
+                    yield row
+
+
+async def compact_orders(batch_size: int = 1000) -> int:
+    # Переносим исполненные/отмененные ордера в orders_history пачками,
+    # чтобы в orders оставались только живые заявки стакана
+    moved = 0
+    while True:
+        async with async_session_maker() as session:
+            q = (
+                select(Order.id)
+                .where(Order.status.in_(TERMINAL_STATUSES))
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            ids = (await session.execute(q)).scalars().all()
+            if not ids:
+                return moved
+            await session.execute(
+                insert(OrderHistory).from_select(
+                    HISTORY_COLUMNS,
+                    select(*[Order.__table__.c[c] for c in HISTORY_COLUMNS]).where(Order.id.in_(ids))
+                )
+            )
+            await session.execute(delete(Order).where(Order.id.in_(ids)))
+            await session.commit()
+        moved += len(ids)
+        if len(ids) < batch_size:
+            return moved
+        await asyncio.sleep(0)
 
 
 async def get_orders(ticker: str, direction: DirectionEnum, limit: int = 10) -> List[Order]:
@@ -78,154 +235,420 @@ async def __get_orders(session, ticker: str, direction: DirectionEnum, limit: in
     return result.scalars().all()
 
 
-async def create_limit_buy_order(ticker, qty, price, user: User):
+async def create_limit_buy_order(ticker, qty, price, user: User,
+                                  time_in_force: TimeInForceEnum = TimeInForceEnum.GTC,
+                                  expires_at: Optional[datetime] = None, client_order_id: Optional[str] = None):
+    return await __submit(__limit_buy, ticker, qty, price, user, time_in_force, expires_at, client_order_id)
+
+
+async def __submit(match, ticker, qty, price, user: User, time_in_force: TimeInForceEnum,
+                   expires_at: Optional[datetime], client_order_id: Optional[str]):
+    if client_order_id is None:
+        return await __place(match, ticker, qty, price, user, time_in_force, expires_at, None)
+    key = (user.id, client_order_id)
+    async with CLIENT_ORDERS.lock(key):
+        # Пока ждали блокировку, ордер мог создать такой же запрос
+        order = CLIENT_ORDERS.get(key)
+        if order is None:
+            # Уникальный ключ есть в каждой таблице отдельно: после compact_orders исходный ордер
+            # лежит в orders_history, и вставка в orders его не заметит
+            order = await get_client_order(user.id, client_order_id)
+        if order is None:
+            order = await __place(match, ticker, qty, price, user, time_in_force, expires_at, client_order_id)
+        CLIENT_ORDERS.put(key, order)
+    return order
+
+
+async def __place(match, ticker, qty, price, user: User, time_in_force: TimeInForceEnum,
+                  expires_at: Optional[datetime], client_order_id: Optional[str]):
     if ticker not in LOCKS:
         LOCKS[ticker] = asyncio.Lock()
     order_lock = LOCKS[ticker]
-    async with acquire_locks(order_lock):
-        async with async_session_maker() as session:
+    try:
+        async with acquire_locks(order_lock):
+            order = await run_with_retry(match, ticker, qty, price, user, time_in_force, expires_at, client_order_id)
+    except IntegrityError:
+        # Повтор, которого нет в кэше (перезапуск, другой узел): вставку отверг уникальный ключ
+        order = await get_client_order(user.id, client_order_id) if client_order_id is not None else None
+        if order is None:
+            raise
+    else:
+        if order.expires_at is not None and order.status in LIVE_STATUSES:
+            EXPIRY.schedule(order.id, ticker, order.expires_at)
+        await trigger_stops(ticker)
+    return order
+
+
+def get_cached_client_order(user_id: UUID, client_order_id: str) -> Optional[Order]:
+    # Только память: повтор отвечает без записи в базу и без блокировки тикера
+    return CLIENT_ORDERS.get((user_id, client_order_id))
+
+
+async def get_client_order(user_id: UUID, client_order_id: str) -> Optional[Order | OrderHistory]:
+    async with async_session_maker() as session:
+        for model in (Order, OrderHistory):
+            q = select(model).where(model.user_id == user_id, model.client_order_id == client_order_id)
+            order = (await session.execute(q)).scalars().first()
+            if order is not None:
+                return order
+    return None
+
+
+async def __limit_buy(ticker, qty, price, user: User, time_in_force: TimeInForceEnum, expires_at: Optional[datetime],
+                      client_order_id: Optional[str] = None):
+    async with async_session_maker() as session:
+        new_order = Order(
+            id=uuid.uuid4(),
+            user_id=user.id,
+            instrument_ticker=ticker,
+            amount=qty,
+            filled=0,
+            price=price,
+            direction=DirectionEnum.BID,
+            status=OrderStatusEnum.NEW,
+            time_in_force=time_in_force,
+            expires_at=expires_at,
+            client_order_id=client_order_id
+        )
+        try:
             orderbook = await __get_orders(session, ticker, DirectionEnum.ASK, qty)
-            new_order = Order(
-                user_id=user.id,
-                instrument_ticker=ticker,
-                amount=qty,
-                filled=0,
-                price=price,
-                direction=DirectionEnum.BID,
-                status=OrderStatusEnum.NEW
-            )
-            try:
-                # Скупаем все что можно
-                for order in orderbook:
-                    if new_order.amount == 0 or (price is not None and order.price > price):
-                        break
-                    count_to_buy = min(order.amount, new_order.amount)
-                    await buy(session, order.user_id, user.id, ticker, order.price, count_to_buy)
-                    await partially_execute_order(session, order, count_to_buy)
-                    await partially_execute_order(session, new_order, count_to_buy)
-
-                # 2
-                if new_order.status != OrderStatusEnum.EXECUTED:
-                    if price is not None:
-                        await freeze_balance(session, user.id, RUB, new_order.amount * new_order.price)
-                    else:
-                        raise Exception('Not enough orders')
-
-                session.add(new_order)
-                await session.commit()
-                return new_order
-
-            except Exception as e:
-                # Не хватило денег
-                print(e)
-                await session.rollback()
-                new_order.filled = 0
-                new_order.amount = qty
-                new_order.status = OrderStatusEnum.CANCELLED
-                session.add(new_order)
-                await session.commit()
-                return new_order
-
-
-async def create_limit_sell_order(ticker, qty, price, user: User):
+            if time_in_force == TimeInForceEnum.FOK and __crossable(orderbook, new_order) < qty:
+                # FOK: глубины не хватает - отклоняем до любых записей
+                raise Exception('Not enough depth for FOK')
+            # Скупаем все что можно
+            await __match_bid(session, new_order, orderbook)
+
+            # 2
+            if new_order.status != OrderStatusEnum.EXECUTED:
+                if time_in_force == TimeInForceEnum.IOC:
+                    # IOC: исполненное остается, остаток снимается сразу
+                    new_order.status = OrderStatusEnum.CANCELLED
+                elif price is not None:
+                    await freeze_balance(session, user.id, RUB, notional(new_order.amount, new_order.price))
+                else:
+                    raise Exception('Not enough orders')
+
+            session.add(new_order)
+            await session.commit()
+            return new_order
+
+        except Exception as e:
+            if is_retryable(e) or isinstance(e, IntegrityError):
+                raise
+            # Не хватило денег
+            print(e)
+            await session.rollback()
+            new_order.filled = 0
+            new_order.amount = qty
+            new_order.status = OrderStatusEnum.CANCELLED
+            session.add(new_order)
+            await session.commit()
+            return new_order
+
+
+async def create_limit_sell_order(ticker, qty, price, user: User,
+                                  time_in_force: TimeInForceEnum = TimeInForceEnum.GTC,
+                                  expires_at: Optional[datetime] = None, client_order_id: Optional[str] = None):
+    return await __submit(__limit_sell, ticker, qty, price, user, time_in_force, expires_at, client_order_id)
+
+
+async def __limit_sell(ticker, qty, price, user: User, time_in_force: TimeInForceEnum, expires_at: Optional[datetime],
+                       client_order_id: Optional[str] = None):
+    async with async_session_maker() as session:
+        new_order = Order(
+            id=uuid.uuid4(),
+            user_id=user.id,
+            instrument_ticker=ticker,
+            amount=qty,
+            filled=0,
+            price=price,
+            direction=DirectionEnum.ASK,
+            status=OrderStatusEnum.NEW,
+            time_in_force=time_in_force,
+            expires_at=expires_at,
+            client_order_id=client_order_id
+        )
+        try:
+            orderbook = await __get_orders(session, ticker, DirectionEnum.BID, qty)
+            if time_in_force == TimeInForceEnum.FOK and __crossable(orderbook, new_order) < qty:
+                # FOK: глубины не хватает - отклоняем до любых записей
+                raise Exception('Not enough depth for FOK')
+            # Продаем все что можно
+            await __match_ask(session, new_order, orderbook)
+
+            # Замораживаем инструменты
+            if new_order.status != OrderStatusEnum.EXECUTED:
+                if time_in_force == TimeInForceEnum.IOC:
+                    new_order.status = OrderStatusEnum.CANCELLED
+                elif price is not None:
+                    await freeze_balance(session, user.id, ticker, new_order.amount)
+                else:
+                    raise Exception('Not enough orders')
+
+            session.add(new_order)
+            await session.commit()
+            return new_order
+
+        except Exception as e:
+            if is_retryable(e) or isinstance(e, IntegrityError):
+                raise
+            # Не хватило инструментов
+            print(e)
+            await session.rollback()
+            new_order.filled = 0
+            new_order.amount = qty
+            new_order.status = OrderStatusEnum.CANCELLED
+            session.add(new_order)
+            await session.commit()
+            return new_order
+
+
+def __plan(orderbook: List[Order], new_order: Order) -> array:
+    prices = array('q', (order.price for order in orderbook))
+    quantities = array('q', (order.amount for order in orderbook))
+    return plan_sweep(prices, quantities, new_order.amount, new_order.price,
+                      ascending=new_order.direction == DirectionEnum.BID)
+
+
+def __crossable(orderbook: List[Order], new_order: Order) -> int:
+    # Сколько можно исполнить против стакана с учетом лимитной цены
+    return sum(__plan(orderbook, new_order))
+
+
+async def __match_bid(session, new_order: Order, orderbook: Optional[List[Order]] = None):
+    if orderbook is None:
+        orderbook = await __get_orders(session, new_order.instrument_ticker, DirectionEnum.ASK, new_order.amount)
+    await __execute_sweep(session, new_order, orderbook, __plan(orderbook, new_order))
+
+
+async def __match_ask(session, new_order: Order, orderbook: Optional[List[Order]] = None):
+    if orderbook is None:
+        orderbook = await __get_orders(session, new_order.instrument_ticker, DirectionEnum.BID, new_order.amount)
+    await __execute_sweep(session, new_order, orderbook, __plan(orderbook, new_order))
+
+
+async def __execute_sweep(session, new_order: Order, orderbook: List[Order], fills: array):
+    is_bid = new_order.direction == DirectionEnum.BID
+    ticker = new_order.instrument_ticker
+    resting = orderbook[:len(fills)]
+    if not resting:
+        # Ничего не пересеклось: ни записей в леджер, ни пустых отчетов о балансе
+        return
+    if any(order.user_id == new_order.user_id for order in resting):
+        # Самосделка: списание и зачисление одного счета проверяются по каждой сделке отдельно
+        for order, amount in zip(resting, fills):
+            if is_bid:
+                await buy(session, order.user_id, new_order.user_id, ticker, order.price, amount)
+            else:
+                await sell(session, new_order.user_id, order.user_id, ticker, order.price, amount)
+            await partially_execute_order(session, order, amount, order.price)
+            await partially_execute_order(session, new_order, amount, order.price)
+        return
+
+    # Сделки и ордера меняются в памяти, счета - одним UPDATE на контрагента и один flush на весь проход
+    counterparties = defaultdict(int)
+    total_qty = 0
+    total_cost = 0
+    for order, amount in zip(resting, fills):
+        cost = notional(amount, order.price)
+        if is_bid:
+            __record_trade(session, order.user_id, new_order.user_id, ticker, order.price, amount)
+            counterparties[order.user_id] += cost
+        else:
+            __record_trade(session, new_order.user_id, order.user_id, ticker, order.price, amount)
+            counterparties[order.user_id] += amount
+        total_qty += amount
+        total_cost += cost
+        await partially_execute_order(session, order, amount, order.price, flush=False)
+        await partially_execute_order(session, new_order, amount, order.price, flush=False)
+    if is_bid:
+        await adjust_balances(session, [(new_order.user_id, -total_cost), *counterparties.items()])
+        await adjust_inventory(session, new_order.user_id, ticker, total_qty)
+    else:
+        await adjust_inventories(session, [(new_order.user_id, ticker, -total_qty),
+                                           *((user_id, ticker, amount) for user_id, amount in counterparties.items())])
+        await adjust_balance(session, new_order.user_id, total_cost)
+    await session.flush()
+
+
+async def create_market_buy_order(ticker, qty, user: User, time_in_force: TimeInForceEnum = TimeInForceEnum.GTC,
+                                  client_order_id: Optional[str] = None):
+    return await create_limit_buy_order(ticker, qty, None, user, time_in_force, client_order_id=client_order_id)
+
+
+async def create_market_sell_order(ticker, qty, user: User, time_in_force: TimeInForceEnum = TimeInForceEnum.GTC,
+                                   client_order_id: Optional[str] = None):
+    return await create_limit_sell_order(ticker, qty, None, user, time_in_force, client_order_id=client_order_id)
+
+
+async def expire_orders(ticker: str, order_ids: List[UUID]) -> int:
     if ticker not in LOCKS:
         LOCKS[ticker] = asyncio.Lock()
-    order_lock = LOCKS[ticker]
-    async with acquire_locks(order_lock):
-        async with async_session_maker() as session:
-            orderbook = await __get_orders(session, ticker, DirectionEnum.BID, qty)
-            new_order = Order(
-                user_id=user.id,
-                instrument_ticker=ticker,
-                amount=qty,
-                filled=0,
-                price=price,
-                direction=DirectionEnum.ASK,
-                status=OrderStatusEnum.NEW
-            )
-            try:
-                # Продаем все что можно
-                for order in orderbook:
-                    if new_order.amount == 0 or (price is not None and order.price < price):
-                        break
-                    count_to_sell = min(order.amount, new_order.amount)
-                    await sell(session, user.id, order.user_id, ticker, order.price, count_to_sell)
-                    await partially_execute_order(session, order, count_to_sell)
-                    await partially_execute_order(session, new_order, count_to_sell)
-
-                # Замораживаем инструменты
-                if new_order.status != OrderStatusEnum.EXECUTED:
-                    if price is not None:
-                        await freeze_balance(session, user.id, ticker, new_order.amount)
-                    else:
-                        raise Exception('Not enough orders')
-
-                session.add(new_order)
-                await session.commit()
-                return new_order
-
-            except Exception as e:
-                # Не хватило инструментов
-                print(e)
-                await session.rollback()
-                new_order.filled = 0
-                new_order.amount = qty
-                new_order.status = OrderStatusEnum.CANCELLED
-                session.add(new_order)
-                await session.commit()
-                return new_order
-
-
-async def create_market_buy_order(ticker, qty, user: User):
-    return await create_limit_buy_order(ticker, qty, None, user)
-
-
-async def create_market_sell_order(ticker, qty, user: User):
-    return await create_limit_sell_order(ticker, qty, None, user)
+    async with acquire_locks(LOCKS[ticker]):
+        return await run_with_retry(__expire, order_ids)
 
 
-async def buy(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
-    buyer = await session.get(User, buyer_id)
-    seller = await session.get(User, seller_id)
+async def __expire(order_ids: List[UUID]) -> int:
+    # Пачка GTD-ордеров снимается одной транзакцией, резервы возвращаются агрегированно
+    async with async_session_maker() as session:
+        q = select(Order).where(Order.id.in_(order_ids), Order.status.in_(LIVE_STATUSES)).with_for_update()
+        orders = (await session.execute(q)).scalars().all()
+        balances = []
+        inventories = []
+        for order in orders:
+            if order.direction == DirectionEnum.BID:
+                balances.append((order.user_id, notional(order.amount, order.price)))
+            else:
+                inventories.append((order.user_id, order.instrument_ticker, order.amount))
+            order.status = OrderStatusEnum.CANCELLED
+        await adjust_balances(session, balances)
+        await adjust_inventories(session, inventories)
+        await session.commit()
+        return len(orders)
+
 
-    buyer_q = select(UserInventory).where(UserInventory.user_id == buyer_id,
-                                          UserInventory.instrument_ticker == ticker)
-    buyer_inv = (await session.execute(buyer_q)).scalars().first()
+async def schedule_pending_expiries() -> int:
+    # При старте заново наполняем кучу дедлайнов из живых GTD-ордеров
+    async with async_session_maker() as session:
+        q = select(Order.id, Order.instrument_ticker, Order.expires_at).where(
+            Order.expires_at.is_not(None), Order.status.in_(LIVE_STATUSES)
+        )
+        rows = (await session.execute(q)).all()
+    for row in rows:
+        EXPIRY.schedule(row.id, row.instrument_ticker, row.expires_at)
+    return len(rows)
 
-    if buyer.balance < amount * price:
-        raise Exception('Not enough balance')
 
-    transaction = Transaction(
-        user_from_id=seller_id,
-        user_to_id=buyer_id,
-        instrument_ticker=ticker,
-        amount=amount,
-        price=price
-    )
-    session.add(transaction)
-    seller.balance += amount * price
-    buyer.balance -= amount * price
-    buyer_inv.quantity += amount
+EXPIRY = ExpiryScheduler(expire_orders)
 
-    await session.flush()
-    return transaction
 
+async def create_stop_order(ticker: str, qty: int, price: Optional[int], stop_price: int,
+                            direction: DirectionEnum, user: User) -> StopOrder:
+    async with async_session_maker() as session:
+        stop = StopOrder(
+            user_id=user.id,
+            instrument_ticker=ticker,
+            amount=qty,
+            price=price,
+            stop_price=stop_price,
+            direction=direction,
+            status=StopStatusEnum.ACTIVE,
+            created_at=datetime.utcnow()
+        )
+        session.add(stop)
+        publish(session, 'invalidate', ('stops', ticker, False))
+        await session.commit()
+    STOPS.add(ticker, stop.id, direction == DirectionEnum.BID, stop_price, stop.created_at)
+    # Стоп, условие которого уже выполнено последней сделкой, срабатывает сразу
+    last_price = await get_last_price(ticker)
+    if last_price is not None:
+        STOPS.observe(ticker, last_price)
+        await trigger_stops(ticker)
+    return stop
 
-async def sell(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
-    seller = await session.get(User, seller_id)
 
-    seller_q = select(UserInventory).where(UserInventory.user_id == seller_id,
-                                           UserInventory.instrument_ticker == ticker)
-    seller_inv = (await session.execute(seller_q)).scalars().first()
+async def get_stop_order(stop_id: str) -> Optional[StopOrder]:
+    async with async_session_maker() as session:
+        return await session.get(StopOrder, UUID(str(stop_id)))
+
 
-    buyer_q = select(UserInventory).where(UserInventory.user_id == buyer_id,
-                                          UserInventory.instrument_ticker == ticker)
-    buyer_inv = (await session.execute(buyer_q)).scalars().first()
+async def cancel_stop_order(stop_id: str, user_id: UUID) -> Optional[StopOrder]:
+    stop_id = UUID(str(stop_id))
+    async with async_session_maker() as session:
+        q = select(StopOrder).where(StopOrder.id == stop_id, StopOrder.user_id == user_id).with_for_update()
+        stop = (await session.execute(q)).scalars().first()
+        if stop is None:
+            return None
+        if stop.status != StopStatusEnum.ACTIVE:
+            raise HTTPException(400, 'Stop order triggered/cancelled')
+        stop.status = StopStatusEnum.CANCELLED
+        publish(session, 'invalidate', ('stops', stop.instrument_ticker, False))
+        await session.commit()
+    STOPS.cancel(stop_id)
+    return stop
+
+
+async def trigger_stops(ticker: str) -> int:
+    # Сработавшие стопы исполняются как новые заявки; их сделки могут включить следующие стопы,
+    # поэтому крутимся, пока в кучах есть сработавшие. Вложенные вызовы из этих же заявок
+    # сразу выходят - их подхватит внешний цикл.
+    if ticker in DRAINING:
+        return 0
+    DRAINING.add(ticker)
+    fired = 0
+    try:
+        while True:
+            stop_ids = STOPS.pop_triggered(ticker)
+            if not stop_ids:
+                return fired
+            for stop_id in stop_ids:
+                fired += await __fire_stop(stop_id)
+    finally:
+        DRAINING.discard(ticker)
+
+
+async def __fire_stop(stop_id: UUID) -> int:
+    async with async_session_maker() as session:
+        q = select(StopOrder).where(StopOrder.id == stop_id, StopOrder.status == StopStatusEnum.ACTIVE) \
+            .with_for_update()
+        stop = (await session.execute(q)).scalars().first()
+        if stop is None:
+            return 0
+        user = await session.get(User, stop.user_id)
+        if user is None or user.deleting:
+            # Владелец удаляется: новых ордеров от его имени не выставляем
+            stop.status = StopStatusEnum.CANCELLED
+            await session.commit()
+            return 0
+        stop.status = StopStatusEnum.TRIGGERED
+        publish(session, 'invalidate', ('stops', stop.instrument_ticker, False))
+        await session.commit()
+
+    # Баланс проверяется только при срабатывании: не хватило - заявка создается отмененной,
+    # а стоп отменяется. Любой другой сбой тоже отменяет стоп, чтобы он не завис в TRIGGERED
+    values = {'status': StopStatusEnum.CANCELLED}
+    try:
+        if stop.direction == DirectionEnum.BID:
+            order = await create_limit_buy_order(stop.instrument_ticker, stop.amount, stop.price, user)
+        else:
+            order = await create_limit_sell_order(stop.instrument_ticker, stop.amount, stop.price, user)
+        values['order_id'] = order.id
+        if order.status == OrderStatusEnum.CANCELLED and not order.filled:
+            logger.warning('stop %s rejected: order %s cancelled', stop_id, order.id)
+        else:
+            del values['status']
+    except Exception:
+        logger.exception('stop %s failed to fire', stop_id)
+
+    async with async_session_maker() as session:
+        await session.execute(update(StopOrder).where(StopOrder.id == stop_id).values(**values))
+        await session.commit()
+    return 0 if 'status' in values else 1
+
+
+async def load_active_stops(ticker: Optional[str] = None) -> int:
+    async with async_session_maker() as session:
+        q = select(StopOrder.id, StopOrder.instrument_ticker, StopOrder.direction, StopOrder.stop_price,
+                   StopOrder.created_at).where(StopOrder.status == StopStatusEnum.ACTIVE)
+        if ticker is not None:
+            q = q.where(StopOrder.instrument_ticker == ticker)
+        rows = (await session.execute(q)).all()
+    STOPS.clear(ticker)
+    for row in rows:
+        STOPS.add(row.instrument_ticker, row.id, row.direction == DirectionEnum.BID, row.stop_price, row.created_at)
+    return len(rows)
 
-    if seller_inv.quantity < amount:
-        raise Exception('Not enough instruments')
 
+STOPS = StopBook()
+DRAINING = set()
+subscribe('trade', lambda t: STOPS.observe(t.instrument_ticker, t.price))
+
+
+def __record_trade(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int,
+                   amount: int) -> Transaction:
     transaction = Transaction(
+        id=uuid.uuid4(),
+        timestamp=datetime.utcnow(),
         user_from_id=seller_id,
         user_to_id=buyer_id,
         instrument_ticker=ticker,
@@ -233,48 +656,251 @@ async def sell(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: s
         price=price
     )
     session.add(transaction)
-    seller.balance += amount * price
-    seller_inv.quantity -= amount
-    buyer_inv.quantity += amount
+    publish(session, 'trade', transaction)
+    return transaction
+
+
+async def buy(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
+    cost = notional(amount, price)
+    transaction = __record_trade(session, seller_id, buyer_id, ticker, price, amount)
+    # Покупатель платит из свободного баланса, инструменты продавца уже заморожены
+    await adjust_balances(session, [(buyer_id, -cost), (seller_id, cost)])
+    await adjust_inventory(session, buyer_id, ticker, amount)
 
     await session.flush()
     return transaction
 
 
-async def partially_execute_order(session: AsyncSession, order: Order, amount: int):
+async def sell(session: AsyncSession, seller_id: UUID, buyer_id: UUID, ticker: str, price: int, amount: int):
+    transaction = __record_trade(session, seller_id, buyer_id, ticker, price, amount)
+    # Продавец отдает свободные инструменты, деньги покупателя уже заморожены
+    await adjust_inventories(session, [(seller_id, ticker, -amount), (buyer_id, ticker, amount)])
+    await adjust_balance(session, seller_id, notional(amount, price))
+
+    await session.flush()
+    return transaction
+
+
+async def partially_execute_order(session: AsyncSession, order: Order, amount: int, price: int, flush: bool = True):
     if order.amount < amount:
         raise Exception('Order not enough amount')
     order.amount -= amount
     order.filled += amount
     order.status = OrderStatusEnum.EXECUTED if order.amount == 0 else OrderStatusEnum.PARTIALLY_EXECUTED
-    await session.flush()
+    publish(session, 'report', (order.user_id, fill_report(order, price, amount)))
+    if flush:
+        await session.flush()
 
 
 async def freeze_balance(session, user_id: UUID, ticker: str, amount: int):
-    inventory: Optional[UserInventory] = None
-    user = await session.get(User, user_id)
-    if ticker != RUB:
-        q = select(UserInventory).where(UserInventory.user_id == user.id,
-                                        UserInventory.instrument_ticker == ticker)
-        inventory = (await session.execute(q)).scalars().first()
-
-    balance = user.balance if ticker == RUB else inventory.quantity
-    if balance < amount:
+    try:
+        if ticker != RUB:
+            await adjust_inventory(session, user_id, ticker, -amount)
+        else:
+            await adjust_balance(session, user_id, -amount)
+    except InsufficientFunds:
         raise Exception('User not enough balance/instruments')
-    if ticker != RUB:
-        inventory.quantity -= amount
-    else:
-        user.balance -= amount
     await session.flush()
 
 
 async def unfreeze_balance(session, user_id: UUID, ticker: str, amount: int):
     if ticker != RUB:
-        q = select(UserInventory).where(UserInventory.user_id == user_id,
-                                        UserInventory.instrument_ticker == ticker)
-        inventory = (await session.execute(q)).scalars().first()
-        inventory.quantity += amount
+        await adjust_inventory(session, user_id, ticker, amount)
     else:
-        user = await session.get(User, user_id)
-        user.balance += amount
+        await adjust_balance(session, user_id, amount)
     await session.flush()
+
+
+def __level(status, price, amount):
+    # Вклад ордера в стакан; status None - еще не примененный default NEW
+    if price is None or not amount or (status is not None and status not in LIVE_STATUSES):
+        return None
+    return price, amount
+
+
+def __committed(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state.obj(), name)
+
+
+@event.listens_for(Session, 'before_flush')
+def __track_depth(session, flush_context, instances):
+    # Изменения уровней копятся как события и применяются к DEPTH только после commit
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(obj, Order):
+            continue
+        state = inspect(obj)
+        old = None if state.pending else __level(*(__committed(state, n) for n in ('status', 'price', 'amount')))
+        new = None if obj in session.deleted else __level(obj.status, obj.price, obj.amount)
+        if old == new:
+            continue
+        is_bid = obj.direction == DirectionEnum.BID
+        if old is not None:
+            publish(session, 'depth', (obj.instrument_ticker, is_bid, old[0], -old[1]))
+        if new is not None:
+            publish(session, 'depth', (obj.instrument_ticker, is_bid, new[0], new[1]))
+
+
+@event.listens_for(Session, 'after_flush')
+def __report_orders(session, flush_context):
+    # Снимок ордера после каждого изменения статуса, объема или цены; id к этому моменту уже есть
+    for obj in (*session.new, *session.dirty):
+        if not isinstance(obj, Order):
+            continue
+        state = inspect(obj)
+        if obj in session.new or any(state.attrs[n].history.has_changes() for n in ('status', 'amount', 'price')):
+            publish(session, 'report', (obj.user_id, order_report(obj)))
+
+
+async def load_depth(ticker: Optional[str] = None) -> int:
+    async with async_session_maker() as session:
+        q = select(Order.instrument_ticker, Order.direction, Order.price, func.sum(Order.amount)).where(
+            Order.status.in_(LIVE_STATUSES), Order.price.is_not(None)
+        ).group_by(Order.instrument_ticker, Order.direction, Order.price)
+        if ticker is not None:
+            q = q.where(Order.instrument_ticker == ticker)
+        rows = (await session.execute(q)).all()
+    DEPTH.clear(ticker)
+    for row_ticker, direction, price, qty in rows:
+        DEPTH.apply(row_ticker, direction == DirectionEnum.BID, price, int(qty))
+    return len(rows)
+
+
+DEPTH = DepthBook()
+subscribe('depth', lambda change: DEPTH.apply(*change))
+
+
+def __reset_ticker(ticker: str) -> None:
+    # Инструмент удален или создан заново: его уровни и стопы в памяти больше не действуют
+    DEPTH.clear(ticker)
+    STOPS.clear(ticker)
+
+
+subscribe('instrument', __reset_ticker)
+
+
+async def load_ticker_stats(ticker: Optional[str] = None) -> int:
+    # Окно за последние сутки одним проходом по сделкам; тикерам без сделок в окне
+    # подтягиваем последнюю цену отдельно
+    if ticker is None:
+        TICKER_STATS.clear()
+        for instrument in await get_all_instruments():
+            TICKER_STATS.track(instrument.ticker)
+    else:
+        TICKER_STATS.drop(ticker)
+        TICKER_STATS.track(ticker)
+    count = 0
+    async for row in stream_transactions(ticker, start=datetime.utcnow() - WINDOW):
+        if row.instrument_ticker is not None and row.price is not None:
+            TICKER_STATS.record(row.instrument_ticker, row.price, row.amount, row.timestamp)
+            count += 1
+    for stats_ticker, stats in TICKER_STATS.tickers.items():
+        if stats.last_price is None and ticker in (None, stats_ticker):
+            stats.last_price = await get_last_price(stats_ticker)
+    return count
+
+
+subscribe('trade', lambda t: TICKER_STATS.record(t.instrument_ticker, t.price, t.amount, t.timestamp))
+subscribe('report', lambda report: REPORTS.push(*report))
+
+
+async def reload_ticker(ticker: str) -> None:
+    # Инструмент создан или удален на другом узле: перечитываем кэши тикера из базы
+    if await get_instrument_by_ticker(ticker) is None:
+        DEPTH.clear(ticker)
+        STOPS.clear(ticker)
+        TICKER_STATS.drop(ticker)
+        RECENT_TRADES.drop(ticker)
+        return
+    await __reload_stable(ticker, load_depth, load_active_stops, load_ticker_stats, load_recent_trades)
+
+
+async def __reload_stable(ticker: Optional[str], *loaders) -> None:
+    # Дельты с других узлов применяются к тем же кэшам: если за время чтения они пришли,
+    # снимок мог их не увидеть или учесть дважды - читаем еще раз. ticker None - все тикеры
+    attempt = 0
+    while True:
+        seen = BOOK_EVENTS[ticker]
+        for load in loaders:
+            await load(ticker)
+        if BOOK_EVENTS[ticker] == seen:
+            return
+        attempt += 1
+        if attempt == RELOAD_ATTEMPTS:
+            logger.warning('caches of %s keep changing during reload, retrying', ticker or 'all tickers')
+        await asyncio.sleep(RELOAD_BACKOFF * min(attempt, RELOAD_ATTEMPTS))
+
+
+async def __reload_stops(ticker: str) -> None:
+    await load_active_stops(ticker)
+
+
+async def __reload_user(user_id: str) -> None:
+    # Ордера удаленного пользователя ушли каскадом, мимо событий стакана
+    REPORTS.drop(UUID(user_id))
+    await __reload_stable(None, load_depth)
+
+
+async def __resync(_) -> None:
+    await __reload_stable(None, load_depth, load_active_stops, load_ticker_stats, load_recent_trades)
+
+
+def __count_book_event(ticker: str) -> None:
+    BOOK_EVENTS[ticker] += 1
+    # Ключ None - счетчик по всем тикерам для полной перезагрузки
+    BOOK_EVENTS[None] += 1
+
+
+def __trade_delta(trade: Transaction) -> dict:
+    return {
+        "id": str(trade.id),
+        "ticker": trade.instrument_ticker,
+        "from": str(trade.user_from_id) if trade.user_from_id else None,
+        "to": str(trade.user_to_id) if trade.user_to_id else None,
+        "amount": trade.amount,
+        "price": trade.price,
+        "timestamp": trade.timestamp.isoformat(),
+    }
+
+
+def __apply_remote_depth(change) -> None:
+    ticker, is_bid, price, delta = change
+    DEPTH.apply(ticker, is_bid, price, delta)
+    __count_book_event(ticker)
+
+
+def __apply_remote_trade(data: dict) -> None:
+    # Сделка с другого узла попадает в те же кэши, что и локальная после commit
+    trade = Transaction(
+        id=UUID(data['id']),
+        timestamp=datetime.fromisoformat(data['timestamp']),
+        user_from_id=UUID(data['from']) if data['from'] else None,
+        user_to_id=UUID(data['to']) if data['to'] else None,
+        instrument_ticker=data['ticker'],
+        amount=data['amount'],
+        price=data['price']
+    )
+    TICKER_STATS.record(trade.instrument_ticker, trade.price, trade.amount, trade.timestamp)
+    RECENT_TRADES.append(trade)
+    STOPS.observe(trade.instrument_ticker, trade.price)
+    __count_book_event(trade.instrument_ticker)
+
+
+RELOAD_ATTEMPTS = 3
+RELOAD_BACKOFF = 0.05
+BOOK_EVENTS = defaultdict(int)
+subscribe('depth', lambda change: __count_book_event(change[0]))
+subscribe('trade', lambda t: __count_book_event(t.instrument_ticker))
+# Изменения стакана и сделки уходят на другие узлы готовыми дельтами, без перечитывания
+subscribe('depth', lambda change: BUS.send('depth', change))
+subscribe('trade', lambda t: BUS.send('trade', __trade_delta(t)))
+BUS.on_delta('depth', __apply_remote_depth)
+BUS.on_delta('trade', __apply_remote_trade)
+BUS.on('stops', __reload_stops)
+BUS.on('instrument', reload_ticker)
+BUS.on('user', __reload_user)
+BUS.on(RESYNC, __resync)
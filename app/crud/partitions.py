@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from core.columnar import ColumnarWriter, ROW_GROUP_SIZE, read_columnar
+from database.database import engine, is_postgres
+
+logger = logging.getLogger(__name__)
+
+TRANSACTIONS_RETENTION_DAYS = int(os.getenv('TRANSACTIONS_RETENTION_DAYS', '90'))
+TRANSACTIONS_PREMAKE_DAYS = int(os.getenv('TRANSACTIONS_PREMAKE_DAYS', '7'))
+TRANSACTIONS_ARCHIVE_DIR = os.getenv('TRANSACTIONS_ARCHIVE_DIR', 'archive/transactions')
+
+PARTITION_PREFIX = 'transactions_p'
+ARCHIVE_COLUMNS = ['id', 'user_from_id', 'user_to_id', 'instrument_ticker', 'amount', 'price', 'timestamp']
+# Индексы из database/models.py: LIKE ... INCLUDING DEFAULTS их не копирует
+TRANSACTION_INDEXES = {
+    'ix_transactions_ticker_timestamp': 'instrument_ticker, "timestamp"',
+    'ix_transactions_user_from_id': 'user_from_id',
+    'ix_transactions_user_to_id': 'user_to_id',
+}
+# Сериализует миграцию и обслуживание между несколькими инстансами приложения
+ADVISORY_LOCK = "SELECT pg_advisory_xact_lock(hashtext('transactions_partitions'))"
+
+
+def __partition_name(day: date) -> str:
+    return f'{PARTITION_PREFIX}{day:%Y%m%d}'
+
+
+def __partition_ddl(day: date) -> str:
+    return (f"CREATE TABLE IF NOT EXISTS {__partition_name(day)} PARTITION OF transactions "
+            f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')")
+
+
+def __archive_path(day: date) -> str:
+    return os.path.join(TRANSACTIONS_ARCHIVE_DIR, f'transactions_{day:%Y%m%d}.zip')
+
+
+def partitioning_supported() -> bool:
+    return is_postgres()
+
+
+async def partition_transactions() -> None:
+    # Одноразовая идемпотентная миграция: обычная таблица transactions
+    # превращается в секционированную по дням (RANGE по timestamp)
+    if not partitioning_supported():
+        return
+    async with engine.begin() as conn:
+        await conn.execute(text(ADVISORY_LOCK))
+        exists = await conn.execute(text(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+            "WHERE c.relname = 'transactions'"
+        ))
+        if exists.first():
+            return
+        logger.warning('partitioning transactions table')
+        first_day = (await conn.execute(text('SELECT min("timestamp")::date FROM transactions'))).scalar()
+        today = datetime.utcnow().date()
+        first_day = min(first_day or today, today)
+
+        await conn.execute(text('ALTER TABLE transactions RENAME TO transactions_legacy'))
+        await conn.execute(text('ALTER TABLE transactions_legacy RENAME CONSTRAINT transactions_pkey TO transactions_legacy_pkey'))
+        for index in TRANSACTION_INDEXES:
+            await conn.execute(text(
+                f'ALTER INDEX IF EXISTS {index} RENAME TO {index.replace("ix_transactions_", "ix_transactions_legacy_")}'
+            ))
+        await conn.execute(text('UPDATE transactions_legacy SET "timestamp" = now() AT TIME ZONE \'utc\' WHERE "timestamp" IS NULL'))
+        await conn.execute(text(
+            'CREATE TABLE transactions (LIKE transactions_legacy INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+        ))
+        await conn.execute(text('ALTER TABLE transactions ALTER COLUMN "timestamp" SET NOT NULL'))
+        await conn.execute(text('ALTER TABLE transactions ADD CONSTRAINT transactions_pkey PRIMARY KEY (id, "timestamp")'))
+        for index, columns in TRANSACTION_INDEXES.items():
+            await conn.execute(text(f'CREATE INDEX {index} ON transactions ({columns})'))
+        await conn.execute(text(
+            'ALTER TABLE transactions ADD FOREIGN KEY (user_from_id) REFERENCES users (id) ON DELETE SET NULL'
+        ))
+        await conn.execute(text(
+            'ALTER TABLE transactions ADD FOREIGN KEY (user_to_id) REFERENCES users (id) ON DELETE SET NULL'
+        ))
+        await conn.execute(text(
+            'ALTER TABLE transactions ADD FOREIGN KEY (instrument_ticker) REFERENCES instruments (ticker) ON DELETE SET NULL'
+        ))
+        day = first_day
+        while day <= today + timedelta(days=TRANSACTIONS_PREMAKE_DAYS):
+            await conn.execute(text(__partition_ddl(day)))
+            day += timedelta(days=1)
+        await conn.execute(text('CREATE TABLE IF NOT EXISTS transactions_default PARTITION OF transactions DEFAULT'))
+        await conn.execute(text('INSERT INTO transactions SELECT * FROM transactions_legacy'))
+        await conn.execute(text('DROP TABLE transactions_legacy'))
+
+
+async def __list_partitions(conn) -> List[date]:
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'transactions' AND c.relname LIKE :prefix"
+    ), {"prefix": PARTITION_PREFIX + '%'})
+    return sorted(datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').date() for name in result.scalars())
+
+
+async def maintain_transaction_partitions() -> None:
+    if not partitioning_supported():
+        return
+    today = datetime.utcnow().date()
+    async with engine.begin() as conn:
+        await conn.execute(text(ADVISORY_LOCK))
+        for i in range(TRANSACTIONS_PREMAKE_DAYS + 1):
+            await conn.execute(text(__partition_ddl(today + timedelta(days=i))))
+        days = await __list_partitions(conn)
+
+    cutoff = today - timedelta(days=TRANSACTIONS_RETENTION_DAYS)
+    for day in days:
+        if day < cutoff:
+            await archive_partition(day)
+
+
+async def archive_partition(day: date) -> int:
+    # Сначала выгружаем секцию на диск, и только после fsync файла удаляем ее из базы
+    os.makedirs(TRANSACTIONS_ARCHIVE_DIR, exist_ok=True)
+    name = __partition_name(day)
+    path = __archive_path(day)
+    async with engine.begin() as conn:
+        await conn.execute(text(ADVISORY_LOCK))
+        # Секция уходит в файл группами по ROW_GROUP_SIZE прямо из серверного курсора,
+        # в памяти не больше одной группы
+        writer = await asyncio.to_thread(ColumnarWriter, path, ARCHIVE_COLUMNS)
+        try:
+            result = await conn.stream(text(f'SELECT {", ".join(ARCHIVE_COLUMNS)} FROM {name}'))
+            async for group in result.partitions(ROW_GROUP_SIZE):
+                await asyncio.to_thread(writer.write_group, [tuple(row) for row in group])
+            count = await asyncio.to_thread(writer.close)
+        except BaseException:
+            await asyncio.to_thread(writer.abort)
+            raise
+        await conn.execute(text(f'ALTER TABLE transactions DETACH PARTITION {name}'))
+        await conn.execute(text(f'DROP TABLE {name}'))
+    logger.warning('archived %s rows of %s to %s', count, name, path)
+    return count
+
+
+def read_archived_transactions(start: date, end: date, ticker: Optional[str] = None,
+                               limit: int = 1000) -> List[dict]:
+    res = []
+    day = start
+    while day <= end and len(res) < limit:
+        path = __archive_path(day)
+        if os.path.exists(path):
+            where = {"instrument_ticker": (lambda v: v == ticker)} if ticker else None
+            for row in read_columnar(path, where=where):
+                res.append(row)
+                if len(res) >= limit:
+                    break
+        day += timedelta(days=1)
+    return res
@@ -0,0 +1,108 @@
+import os
+from typing import AsyncIterator, Dict, Iterable, Optional
+from uuid import UUID
+
+from sqlalchemy import select, union_all, case, literal, func
+
+from core.money import notional, to_major
+from core.tickerstats import TICKER_STATS
+from database.database import async_session_maker
+from database.models import User, UserInventory, Order, DirectionEnum, OrderStatusEnum
+
+RUB = os.getenv('BASE_INSTRUMENT_TICKER')
+LIVE_STATUSES = [OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]
+
+# Оценка портфеля по последней цене сделки. Доступное - остатки user_inventories и баланс,
+# зарезервированное - то, что заморожено живыми ордерами: инструменты под продажу и рубли
+# под покупку. Цены берутся из TICKER_STATS, который обновляется сделками в crud/order.py,
+# так что в базу уходит один запрос на пользователя или один поток на всех.
+
+
+def __holdings(user_id: Optional[UUID] = None):
+    inventory = select(
+        UserInventory.user_id,
+        UserInventory.instrument_ticker.label('ticker'),
+        UserInventory.quantity.label('available'),
+        literal(0).label('reserved'),
+    ).where(UserInventory.quantity != 0)
+    reserved = select(
+        Order.user_id,
+        case((Order.direction == DirectionEnum.ASK, Order.instrument_ticker), else_=literal(RUB)).label('ticker'),
+        literal(0).label('available'),
+        # То же, что notional(amount, price) в core/money.py
+        case((Order.direction == DirectionEnum.ASK, Order.amount), else_=Order.amount * Order.price).label('reserved'),
+    ).where(Order.status.in_(LIVE_STATUSES), Order.amount > 0)
+    if user_id is not None:
+        inventory = inventory.where(UserInventory.user_id == user_id)
+        reserved = reserved.where(Order.user_id == user_id)
+    holdings = union_all(inventory, reserved).subquery()
+    stmt = (
+        select(User.id, User.balance, holdings.c.ticker,
+               func.sum(holdings.c.available).label('available'),
+               func.sum(holdings.c.reserved).label('reserved'))
+        .outerjoin(holdings, holdings.c.user_id == User.id)
+        .group_by(User.id, User.balance, holdings.c.ticker)
+        .order_by(User.id)
+    )
+    if user_id is not None:
+        stmt = stmt.where(User.id == user_id)
+    return stmt
+
+
+def value_portfolio(user_id: UUID, balance: int, rows: Iterable) -> dict:
+    """rows - (ticker, available, reserved) одного пользователя; ticker None - позиций нет."""
+    positions: Dict[str, dict] = {}
+    cash = {"available": balance, "reserved": 0}
+    total = balance
+    unpriced = []
+    for ticker, available, reserved in rows:
+        if ticker is None:
+            continue
+        if ticker == RUB:
+            cash["reserved"] += reserved
+            total += reserved
+            continue
+        quantity = available + reserved
+        price = TICKER_STATS.last_price(ticker)
+        value = notional(quantity, price) if price is not None else None
+        if value is None:
+            unpriced.append(ticker)
+        else:
+            total += value
+        positions[ticker] = {
+            "available": available,
+            "reserved": reserved,
+            "price": to_major(price) if price is not None else None,
+            "value": to_major(value) if value is not None else None,
+        }
+    return {
+        "user_id": user_id,
+        RUB: {"available": to_major(cash["available"]), "reserved": to_major(cash["reserved"])},
+        "positions": positions,
+        "total": to_major(total),
+        "unpriced": unpriced,
+    }
+
+
+async def get_portfolio(user_id: UUID) -> Optional[dict]:
+    async with async_session_maker() as session:
+        rows = (await session.execute(__holdings(user_id))).all()
+    if not rows:
+        return None
+    return value_portfolio(user_id, rows[0].balance, ((r.ticker, r.available, r.reserved) for r in rows))
+
+
+async def stream_portfolios(batch: int = 5000) -> AsyncIterator[dict]:
+    # Строки отсортированы по пользователю: портфель собирается из подряд идущих строк
+    async with async_session_maker() as session:
+        result = await session.stream(__holdings().execution_options(yield_per=batch))
+        user_id, balance, rows = None, 0, []
+        async for partition in result.partitions():
+            for row in partition:
+                if row.id != user_id:
+                    if user_id is not None:
+                        yield value_portfolio(user_id, balance, rows)
+                    user_id, balance, rows = row.id, row.balance, []
+                rows.append((row.ticker, row.available, row.reserved))
+        if user_id is not None:
+            yield value_portfolio(user_id, balance, rows)
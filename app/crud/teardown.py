@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+from uuid import UUID
+
+from sqlalchemy import select, delete, update, func, text, tuple_
+
+from crud.bus import RESYNC
+from crud.events import publish
+from crud.locks import LOCKS, acquire_locks
+from core.idempotency import CLIENT_ORDERS
+from crud.order import LIVE_STATUSES, STOPS
+from crud.user import delete_user
+from database.database import async_session_maker, is_postgres
+from database.models import User, Order, OrderHistory, StopOrder, UserInventory, Transaction
+
+logger = logging.getLogger(__name__)
+
+# Массовое удаление. Строки пользователя удаляются пачками по TEARDOWN_BATCH, каждая пачка -
+# отдельная короткая транзакция под блокировками, так что торговля не стоит на все удаление.
+# Пользователь, у которого строк больше USER_DELETE_INLINE_LIMIT, удаляется фоновой задачей,
+# а до ее конца помечен users.deleting.
+TEARDOWN_BATCH = int(os.getenv('TEARDOWN_BATCH', '5000'))
+USER_DELETE_INLINE_LIMIT = int(os.getenv('USER_DELETE_INLINE_LIMIT', '10000'))
+# Все, что ссылается на инструменты; TRUNCATE одним списком не требует CASCADE
+RESET_TABLES = ['transactions', 'orders_history', 'stop_orders', 'orders', 'user_inventories', 'instruments']
+
+
+class DeletionJob:
+    def __init__(self, user_id: UUID):
+        self.user_id = user_id
+        self.status = 'running'
+        self.deleted: Counter = Counter()
+        self.started_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "status": self.status,
+            "deleted": dict(self.deleted),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+JOBS: Dict[UUID, DeletionJob] = {}
+
+
+async def count_user_rows(user_id: UUID) -> int:
+    async with async_session_maker() as session:
+        total = 0
+        for model in (Order, OrderHistory):
+            q = select(func.count()).select_from(model).where(model.user_id == user_id)
+            total += (await session.execute(q)).scalar()
+        return total
+
+
+async def start_user_deletion(user_id: UUID) -> DeletionJob:
+    job = JOBS.get(user_id)
+    if job is not None and job.status == 'running':
+        return job
+    # Флаг в базе виден всем узлам: авторизация и стоп-заявки пользователя отключаются до
+    # первой удаленной пачки
+    async with async_session_maker() as session:
+        await session.execute(update(User).where(User.id == user_id).values(deleting=True))
+        await session.commit()
+    job = JOBS[user_id] = DeletionJob(user_id)
+    job.task = asyncio.get_running_loop().create_task(__run_user_deletion(job))
+    return job
+
+
+async def __run_user_deletion(job: DeletionJob) -> None:
+    try:
+        # Стопы первыми, чтобы они не выставили новых ордеров посреди удаления
+        while await __delete_chunk(job, StopOrder):
+            pass
+        # Живые ордера - через ORM, чтобы стакан получил события; их немного
+        while await __delete_live_orders(job):
+            pass
+        for model in (Order, OrderHistory, UserInventory):
+            while await __delete_chunk(job, model):
+                pass
+        # Сделки остаются, ссылки на пользователя обнуляются теми же пачками
+        for column in (Transaction.user_from_id, Transaction.user_to_id):
+            while await __detach_trades(job, column):
+                pass
+        # Зависимых строк не осталось: каскады на users находят по индексам пустые выборки
+        await delete_user(str(job.user_id))
+        job.status = 'done'
+    except Exception:
+        # Флаг deleting остается: повторный DELETE запустит задачу заново
+        logger.exception('deletion of user %s failed', job.user_id)
+        job.status = 'failed'
+    finally:
+        job.finished_at = datetime.utcnow()
+
+
+async def __delete_live_orders(job: DeletionJob) -> int:
+    async with acquire_locks(*LOCKS.values()):
+        async with async_session_maker() as session:
+            q = select(Order).where(Order.user_id == job.user_id, Order.status.in_(LIVE_STATUSES)) \
+                .limit(TEARDOWN_BATCH)
+            orders = (await session.execute(q)).scalars().all()
+            for order in orders:
+                await session.delete(order)
+            await session.commit()
+    job.deleted['orders'] += len(orders)
+    return len(orders)
+
+
+async def __delete_chunk(job: DeletionJob, model) -> int:
+    chunk = select(model.id).where(model.user_id == job.user_id).limit(TEARDOWN_BATCH)
+    async with acquire_locks(*LOCKS.values()):
+        async with async_session_maker() as session:
+            result = await session.execute(delete(model).where(model.id.in_(chunk)).returning(model.id))
+            ids = result.scalars().all()
+            await session.commit()
+    if model is StopOrder:
+        for stop_id in ids:
+            STOPS.cancel(stop_id)
+    job.deleted[model.__tablename__] += len(ids)
+    return len(ids)
+
+
+async def __detach_trades(job: DeletionJob, column) -> int:
+    # Пачка по первичному ключу (id, timestamp), чтобы UPDATE секционированной таблицы
+    # не сканировал все секции
+    chunk = select(Transaction.id, Transaction.timestamp).where(column == job.user_id).limit(TEARDOWN_BATCH)
+    async with acquire_locks(*LOCKS.values()):
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(Transaction).where(tuple_(Transaction.id, Transaction.timestamp).in_(chunk))
+                .values({column.key: None})
+            )
+            await session.commit()
+    job.deleted[f'transactions.{column.key}'] += result.rowcount
+    return result.rowcount
+
+
+async def reset_exchange() -> None:
+    # Торговое состояние целиком: инструменты, ордера, сделки, остатки; пользователи остаются
+    # с нулевым балансом. Кэши этого и остальных узлов перечитываются через RESYNC
+    async with acquire_locks(*LOCKS.values()):
+        async with async_session_maker() as session:
+            if is_postgres():
+                await session.execute(text(f'TRUNCATE {", ".join(RESET_TABLES)}'))
+            else:
+                for table in RESET_TABLES:
+                    await session.execute(text(f'DELETE FROM {table}'))
+            await session.execute(update(User).values(balance=0))
+            publish(session, 'invalidate', (RESYNC, None, True))
+            await session.commit()
+    CLIENT_ORDERS.clear()
+    LOCKS.clear()
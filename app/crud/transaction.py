@@ -1,28 +1,62 @@
-from typing import List
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import select, Row
 
+from core.recent import RECENT_TRADES
+from crud.events import publish, subscribe
 from database.database import async_session_maker
 from database.models import Transaction, Instrument
 
 
 async def get_transactions_by_ticker(ticker: str, limit: int = 10) -> List[Transaction]:
+    # В пределах глубины кольца отвечаем из памяти, глубже - индексное чтение
+    trades = RECENT_TRADES.latest(ticker, limit)
+    if trades is not None:
+        return trades
+    async with async_session_maker() as session:
+        return await __latest_transactions(session, ticker, limit)
+
+
+async def __latest_transactions(session, ticker: str, limit: int) -> List[Transaction]:
+    stmt = (
+        select(Transaction)
+        .where(Transaction.instrument_ticker == ticker)
+        .order_by(Transaction.timestamp.desc())
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.scalars().all()
+
+
+async def load_recent_trades(ticker: Optional[str] = None) -> int:
+    count = 0
+    async with async_session_maker() as session:
+        if ticker is None:
+            RECENT_TRADES.clear()
+            tickers = (await session.execute(select(Instrument.ticker))).scalars().all()
+        else:
+            tickers = [ticker]
+        for ticker in tickers:
+            trades = await __latest_transactions(session, ticker, RECENT_TRADES.depth)
+            RECENT_TRADES.seed(ticker, trades)
+            count += len(trades)
+    return count
+
+
+async def get_last_price(ticker: str) -> Optional[int]:
     async with async_session_maker() as session:
         stmt = (
-            select(Transaction)
-            .join(Transaction.instrument)
-            .filter(Instrument.ticker == ticker)
+            select(Transaction.price)
+            .where(Transaction.instrument_ticker == ticker)
             .order_by(Transaction.timestamp.desc())
-            .limit(limit)
+            .limit(1)
         )
+        return (await session.execute(stmt)).scalar()
 
-        result = await session.execute(stmt)
-        transactions = result.scalars().all()
-
-        return transactions
 
-
-async def create_transaction(user_from_id: str, user_to_id: str, ticker: str, amount: int, price: float) -> Transaction:
+async def create_transaction(user_from_id: str, user_to_id: str, ticker: str, amount: int, price: int) -> Transaction:
     async with async_session_maker() as session:
         t = await __create_transaction(session, user_from_id, user_to_id, ticker, amount, price)
         await session.commit()
@@ -32,8 +66,10 @@ async def create_transaction(user_from_id: str, user_to_id: str, ticker: str, am
 
 
 async def __create_transaction(session, user_from_id: str, user_to_id: str, ticker: str, amount: int,
-                               price: float) -> Transaction:
+                               price: int) -> Transaction:
     transaction = Transaction(
+        id=uuid.uuid4(),
+        timestamp=datetime.utcnow(),
         user_from_id=user_from_id,
         user_to_id=user_to_id,
         instrument_ticker=ticker,
@@ -41,4 +77,25 @@ async def __create_transaction(session, user_from_id: str, user_to_id: str, tick
         price=price
     )
     session.add(transaction)
+    publish(session, 'trade', transaction)
     return transaction
+
+
+async def stream_transactions(ticker: Optional[str] = None, start: Optional[datetime] = None,
+                              end: Optional[datetime] = None, batch: int = 5000) -> AsyncIterator[Row]:
+    # Серверный курсор: строки приходят пачками по batch, память не растет с объемом выгрузки
+    stmt = select(*Transaction.__table__.columns).order_by(Transaction.timestamp)
+    if ticker:
+        stmt = stmt.where(Transaction.instrument_ticker == ticker)
+    if start:
+        stmt = stmt.where(Transaction.timestamp >= start)
+    if end:
+        stmt = stmt.where(Transaction.timestamp < end)
+    async with async_session_maker() as session:
+        result = await session.stream(stmt.execution_options(yield_per=batch))
+        async for partition in result.partitions():
+            for row in partition:
+                yield row
+
+
+subscribe('trade', RECENT_TRADES.append)
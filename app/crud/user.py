@@ -1,26 +1,30 @@
 import asyncio
 import os
 import uuid
-from typing import Optional, List
+from typing import Optional, List, Callable
 
 from fastapi import HTTPException
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, insert, update, delete
 
+from crud.ledger import adjust_balance, adjust_inventory, InsufficientFunds, run_with_retry
+from crud.events import publish
 from crud.locks import acquire_locks, LOCKS
-from database.models import User, RoleEnum, Instrument, UserInventory, Order
+from database.models import User, RoleEnum, Instrument, UserInventory, Order, OrderHistory
 from database.database import async_session_maker
 
 
-async def create_user(name: str, role: RoleEnum=RoleEnum.USER) -> User:
+async def create_user(name: str, role: RoleEnum=RoleEnum.USER, user_id: Optional[uuid.UUID] = None,
+                      api_key: Optional[str] = None) -> User:
     async with async_session_maker() as session:
-        new_user = User(name=name, role=role)
+        new_user = User(name=name, role=role, api_key=api_key)
+        if user_id is not None:
+            new_user.id = user_id
         session.add(new_user)
 
         result = await session.execute(select(Instrument))
         instruments = result.scalars().all()
         for instrument in instruments:
-            inv = UserInventory(user=new_user, instrument=instrument, quantity=0.0)
+            inv = UserInventory(user=new_user, instrument=instrument, quantity=0)
             session.add(inv)
 
         await session.commit()
@@ -28,6 +32,34 @@ async def create_user(name: str, role: RoleEnum=RoleEnum.USER) -> User:
         return new_user
 
 
+async def create_users(names: List[str], key_factory: Callable[[dict], str],
+                       role: RoleEnum = RoleEnum.USER) -> List[dict]:
+    async with async_session_maker() as session:
+        result = await session.execute(
+            insert(User).returning(User.id, User.name, sort_by_parameter_order=True),
+            [{"name": name, "role": role} for name in names]
+        )
+        created = [{"name": row.name, "id": str(row.id), "role": role.name} for row in result]
+
+        tickers = (await session.execute(select(Instrument.ticker))).scalars().all()
+        if tickers:
+            await session.execute(
+                insert(UserInventory),
+                [{"user_id": uuid.UUID(u["id"]), "instrument_ticker": t, "quantity": 0}
+                 for u in created for t in tickers]
+            )
+
+        for u in created:
+            u["api_key"] = key_factory({"name": u["name"], "id": u["id"], "role": u["role"]})
+        await session.execute(
+            update(User),
+            [{"id": uuid.UUID(u["id"]), "api_key": u["api_key"]} for u in created]
+        )
+
+        await session.commit()
+        return created
+
+
 async def get_user(uuid_str: str) -> Optional[User]:
     async with async_session_maker() as session:
         user_uuid = uuid.UUID(uuid_str)
@@ -35,26 +67,24 @@ async def get_user(uuid_str: str) -> Optional[User]:
         user = result.scalars().first()
         return user
 
-async def apply_api_key(uuid_str: str, key:str):
-    async with async_session_maker() as session:
-        user = await get_user(uuid_str)
-        user.api_key = key
-        session.add(user)
-        await session.commit()
-        return user
-
 async def delete_user(uuid_str: str) -> Optional[User]:
     async with acquire_locks(*LOCKS.values()):
         async with async_session_maker() as session:
             user = await get_user(uuid_str)
             if not user:
                 raise HTTPException(status_code=404, detail='Пользователь с таким id не найден')
-            await session.delete(user)
+            # Ордера, остатки и история уходят ON DELETE CASCADE в базе, без загрузки в ORM
+            await session.execute(delete(User).where(User.id == user.id))
+            publish(session, 'invalidate', ('user', str(user.id), True))
             await session.commit()
             #await asyncio.sleep(1)
             return user
 
 async def change_balance(id: [uuid.UUID, str], ticker: str, amount: int) -> Optional[User]:
+    return await run_with_retry(__change_balance_tx, id, ticker, amount)
+
+
+async def __change_balance_tx(id: [uuid.UUID, str], ticker: str, amount: int) -> Optional[User]:
     async with async_session_maker() as session:
         b = await __change_balance(session, id, ticker, amount)
         await session.commit()
@@ -63,40 +93,29 @@ async def change_balance(id: [uuid.UUID, str], ticker: str, amount: int) -> Opti
 
 
 async def __change_balance(session, id: [uuid.UUID, str], ticker: str, amount: int) -> Optional[User]:
-    id = str(id)
-    if ticker == os.getenv('BASE_INSTRUMENT_TICKER'):
-        user = await session.get(User, uuid.UUID(id))
-        if user is None:
-            user = await get_user(id)
-        new_balance = user.balance + amount
-        if new_balance < 0:
-            raise HTTPException(status_code=400, detail='Balance must be >= 0')
-        user.balance = new_balance
-        session.add(user)
-    else:
-        result = await session.execute(
-            select(User).where(User.id == uuid.UUID(id)).options(selectinload(User.inventory))
-        )
-        user = result.scalar_one_or_none()
-        for inv in user.inventory:
-            if inv.instrument_ticker == ticker:
-                new_balance = inv.quantity + amount
-                if new_balance < 0:
-                    raise HTTPException(status_code=400, detail='Balance must be >= 0')
-                inv.quantity = new_balance
-                session.add(inv)
-                break
+    user_id = uuid.UUID(str(id))
+    try:
+        if ticker == os.getenv('BASE_INSTRUMENT_TICKER'):
+            await adjust_balance(session, user_id, amount)
+        else:
+            await adjust_inventory(session, user_id, ticker, amount)
+    except InsufficientFunds:
+        raise HTTPException(status_code=400, detail='Balance must be >= 0')
+    return await session.get(User, user_id)
 
-    #await session.commit()
-    return user
 
 
 
-
-async def get_user_orders(uuid_str: str) -> List[Order]:
+async def get_user_orders(uuid_str: str, include_history: bool = True) -> List[Order | OrderHistory]:
     async with async_session_maker() as session:
+        user_uuid = uuid.UUID(uuid_str)
         result = await session.execute(
-            select(Order).where(Order.user_id == uuid.UUID(uuid_str))
+            select(Order).where(Order.user_id == user_uuid)
         )
-        orders = result.scalars().all()
+        orders = list(result.scalars().all())
+        if include_history:
+            result = await session.execute(
+                select(OrderHistory).where(OrderHistory.user_id == user_uuid)
+            )
+            orders.extend(result.scalars().all())
         return orders
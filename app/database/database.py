@@ -1,5 +1,7 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import StaticPool
 import os
 from dotenv import load_dotenv
 # load_dotenv(".env")
@@ -8,17 +10,55 @@ postgres_password = os.getenv("POSTGRES_PASSWORD")
 postgres_host = os.getenv("POSTGRES_HOST")
 postgres_port = os.getenv("POSTGRES_PORT")
 postgres_db = os.getenv("POSTGRES_DB")
-DATABASE_URL = f'postgresql+asyncpg://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}'
+# DATABASE_URL выбирает хранилище: postgresql+asyncpg://... (по умолчанию, из POSTGRES_*)
+# или встроенный sqlite+aiosqlite:///path/to/db.sqlite
+DATABASE_URL = os.getenv('DATABASE_URL') or \
+    f'postgresql+asyncpg://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}'
 print(DATABASE_URL)
-engine = create_async_engine(
-    DATABASE_URL,
-    echo=False,
-    pool_size=10,
-    max_overflow=15,
-    pool_recycle=1800,
-    pool_pre_ping=True,
-    pool_timeout=30
-)
+
+
+def is_sqlite_url(url: str) -> bool:
+    return url.startswith('sqlite')
+
+
+def create_database_engine(url: str) -> AsyncEngine:
+    if not is_sqlite_url(url):
+        return create_async_engine(
+            url,
+            echo=False,
+            pool_size=10,
+            max_overflow=15,
+            pool_recycle=1800,
+            pool_pre_ping=True,
+            pool_timeout=30
+        )
+
+    memory = ':memory:' in url or url.rstrip('/').endswith('sqlite+aiosqlite:')
+    sqlite_engine = create_async_engine(
+        url,
+        echo=False,
+        connect_args={"timeout": 30},
+        poolclass=StaticPool if memory else None,
+    )
+
+    @event.listens_for(sqlite_engine.sync_engine, 'connect')
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not memory:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.execute('PRAGMA busy_timeout=30000')
+        cursor.close()
+
+    return sqlite_engine
+
+
+engine = create_database_engine(DATABASE_URL)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+def is_postgres() -> bool:
+    return engine.dialect.name == 'postgresql'
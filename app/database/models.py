@@ -1,11 +1,41 @@
 import uuid
 
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Enum
+from sqlalchemy import Column, BigInteger, String, DateTime, ForeignKey, Enum, Uuid, TypeDecorator, Index, \
+    UniqueConstraint, Boolean, false
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import FunctionElement
 from database.database import Base
 from datetime import datetime
 from enum import Enum as PythonEnum
-from sqlalchemy.dialects.postgresql import UUID
+
+class gen_uuid(FunctionElement):
+    # Серверная генерация uuid, одинаково работающая в PostgreSQL и SQLite
+    type = Uuid()
+    inherit_cache = True
+
+
+@compiles(gen_uuid)
+def __gen_uuid_default(element, compiler, **kw):
+    return 'gen_random_uuid()'
+
+
+@compiles(gen_uuid, 'sqlite')
+def __gen_uuid_sqlite(element, compiler, **kw):
+    # Uuid в SQLite хранится как 32 hex-символа без дефисов
+    return '(lower(hex(randomblob(16))))'
+
+
+class MoneyType(TypeDecorator):
+    # Сумма в минимальных единицах (см. core/money.py), float сюда попадать не должен
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and not isinstance(value, int):
+            raise TypeError(f'Money column expects int minor units, got {type(value).__name__}')
+        return value
+
 
 class RoleEnum(PythonEnum):
     USER = "user"
@@ -15,6 +45,17 @@ class DirectionEnum(PythonEnum):
     ASK = "ask"
     BID = "bid"
 
+class TimeInForceEnum(PythonEnum):
+    GTC = "GTC"
+    IOC = "IOC"
+    FOK = "FOK"
+    GTD = "GTD"
+
+class StopStatusEnum(PythonEnum):
+    ACTIVE = "ACTIVE"
+    TRIGGERED = "TRIGGERED"
+    CANCELLED = "CANCELLED"
+
 class OrderStatusEnum(PythonEnum):
     NEW = "NEW"
     EXECUTED = "EXECUTED"
@@ -24,24 +65,27 @@ class OrderStatusEnum(PythonEnum):
 class User(Base):
     __tablename__ = 'users'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    # id генерирует сервер, чтобы массовая вставка обходилась одним INSERT ... RETURNING
+    id = Column(Uuid, primary_key=True, server_default=gen_uuid())
     name = Column(String, unique=False, nullable=False)
     role = Column(Enum(RoleEnum), default=RoleEnum.USER)
-    balance = Column(Float, default=0.0)
+    balance = Column(MoneyType, nullable=False, default=0)
     api_key = Column(String, unique=False, nullable=True)
+    # Пользователь удаляется фоновой задачей: запросы от его имени и стоп-заявки уже не принимаются
+    deleting = Column(Boolean, nullable=False, default=False, server_default=false())
     # Создаем отношения
     orders = relationship("Order", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
-    transactions_sent = relationship("Transaction", foreign_keys='Transaction.user_from_id', back_populates="user_from")
-    transactions_received = relationship("Transaction", foreign_keys='Transaction.user_to_id', back_populates="user_to")
+    transactions_sent = relationship("Transaction", foreign_keys='Transaction.user_from_id', back_populates="user_from", passive_deletes=True)
+    transactions_received = relationship("Transaction", foreign_keys='Transaction.user_to_id', back_populates="user_to", passive_deletes=True)
     inventory = relationship("UserInventory", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 class UserInventory(Base):
     __tablename__ = 'user_inventories'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    user_id = Column(Uuid, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
     instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), nullable=False)
-    quantity = Column(Float, nullable=False, default=0.0)
+    quantity = Column(BigInteger, nullable=False, default=0)
 
     # Создаем отношения
     user = relationship("User", back_populates="inventory")
@@ -51,37 +95,93 @@ class UserInventory(Base):
 class Order(Base):
     __tablename__ = 'orders'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete="CASCADE"), nullable=False)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    user_id = Column(Uuid, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
     instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), nullable=False)
-    amount = Column(Integer, nullable=False)
-    filled = Column(Integer, nullable=False, default=0)
-    price = Column(Integer, nullable=True)
+    amount = Column(BigInteger, nullable=False)
+    filled = Column(BigInteger, nullable=False, default=0)
+    price = Column(MoneyType, nullable=True)
     direction = Column(Enum(DirectionEnum), nullable=False)
     status = Column(Enum(OrderStatusEnum), default=OrderStatusEnum.NEW)
     created_at = Column(DateTime, default=datetime.utcnow)
+    time_in_force = Column(Enum(TimeInForceEnum), nullable=False, default=TimeInForceEnum.GTC,
+                           server_default=TimeInForceEnum.GTC.name)
+    expires_at = Column(DateTime, nullable=True)
+    # Ключ идемпотентности клиента: повтор POST с тем же id возвращает исходный ордер
+    client_order_id = Column(String(64), nullable=True)
 
     # Создаем отношения
     user = relationship("User", back_populates="orders")
     instrument = relationship("Instrument")
 
+    __table_args__ = (
+        UniqueConstraint('user_id', 'client_order_id', name='uq_orders_user_client_order_id'),
+    )
+
+
+
+class OrderHistory(Base):
+    # Исполненные и отмененные ордера, перенесенные из orders фоновым уплотнением
+    __tablename__ = 'orders_history'
+
+    id = Column(Uuid, primary_key=True)
+    user_id = Column(Uuid, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
+    instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    filled = Column(BigInteger, nullable=False, default=0)
+    price = Column(MoneyType, nullable=True)
+    direction = Column(Enum(DirectionEnum), nullable=False)
+    status = Column(Enum(OrderStatusEnum), nullable=False)
+    created_at = Column(DateTime)
+    time_in_force = Column(Enum(TimeInForceEnum), nullable=False, default=TimeInForceEnum.GTC,
+                           server_default=TimeInForceEnum.GTC.name)
+    expires_at = Column(DateTime, nullable=True)
+    client_order_id = Column(String(64), nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'client_order_id', name='uq_orders_history_user_client_order_id'),
+    )
+
+
+class StopOrder(Base):
+    # Стоп-заявка ждет сделки по цене stop_price, затем превращается в обычный ордер order_id
+    __tablename__ = 'stop_orders'
+
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    user_id = Column(Uuid, ForeignKey('users.id', ondelete="CASCADE"), nullable=False, index=True)
+    instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="CASCADE"), nullable=False)
+    amount = Column(BigInteger, nullable=False)
+    price = Column(MoneyType, nullable=True)
+    stop_price = Column(MoneyType, nullable=False)
+    direction = Column(Enum(DirectionEnum), nullable=False)
+    status = Column(Enum(StopStatusEnum), nullable=False, default=StopStatusEnum.ACTIVE)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    order_id = Column(Uuid, nullable=True)
 
 class Transaction(Base):
     __tablename__ = 'transactions'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_from_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete="SET NULL"), nullable=True)
-    user_to_id = Column(UUID(as_uuid=True), ForeignKey('users.id', ondelete="SET NULL"), nullable=True)
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    # Индексы нужны удалению пользователя: ON DELETE SET NULL и обнуление ссылок пачками
+    user_from_id = Column(Uuid, ForeignKey('users.id', ondelete="SET NULL"), nullable=True, index=True)
+    user_to_id = Column(Uuid, ForeignKey('users.id', ondelete="SET NULL"), nullable=True, index=True)
     instrument_ticker = Column(String(10), ForeignKey('instruments.ticker', ondelete="SET NULL"), nullable=True)
-    amount = Column(Float, nullable=False)
-    price = Column(Float, nullable=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    amount = Column(BigInteger, nullable=False)
+    price = Column(MoneyType, nullable=True)
+    # Таблица секционирована по дням, ключ секционирования входит в первичный ключ
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
 
     # Создаем отношения
     user_from = relationship("User", foreign_keys=[user_from_id], back_populates="transactions_sent")
     user_to = relationship("User", foreign_keys=[user_to_id], back_populates="transactions_received")
     instrument = relationship("Instrument")
 
+    # Последние сделки тикера читаются по этому индексу без сортировки
+    __table_args__ = (
+        Index('ix_transactions_ticker_timestamp', 'instrument_ticker', 'timestamp'),
+    )
+
 
 class Instrument(Base):
     __tablename__ = 'instruments'
@@ -92,4 +192,4 @@ class Instrument(Base):
     # Обратные связи (если нужны)
     inventories = relationship("UserInventory", back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
     orders = relationship("Order", back_populates="instrument", cascade="all, delete-orphan", passive_deletes=True)
-    transactions = relationship("Transaction", back_populates="instrument")
+    transactions = relationship("Transaction", back_populates="instrument", passive_deletes=True)
@@ -1,7 +1,9 @@
 import uuid
 
-from fastapi import HTTPException
+from fastapi import HTTPException, Depends
 
+from api.v1.auth.jwt import oauth2_scheme, decode_user_id, load_current_user
+from core.admission import check_rate
 from crud.instrument import get_instrument_by_ticker
 from crud.user import get_user
 from database.models import Instrument, User
@@ -18,4 +20,13 @@ async def get_user_depend(user_id: uuid.UUID) -> User:
     user = await get_user(user_id)
     if not user:
         raise HTTPException(404)
-    return user
\ No newline at end of file
+    return user
+
+
+def rate_limited(endpoint_class: str):
+    # Корзина по id из токена: запрос сверх лимита отбивается до запроса пользователя в базу
+    async def depend(token: str = Depends(oauth2_scheme)) -> User:
+        user_id = decode_user_id(token)
+        check_rate(endpoint_class, user_id)
+        return await load_current_user(user_id)
+    return depend
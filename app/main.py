@@ -1,17 +1,20 @@
 import logging
 
 from dotenv import load_dotenv
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
 
 load_dotenv('.env')
 
 import uvicorn
 from fastapi import FastAPI
 from api.router import router
+from background import lifespan
+from database.database import engine
+from profiling import ProfilingMiddleware, install_sql_tracing
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ProfilingMiddleware)
+install_sql_tracing(engine)
 app.include_router(router, prefix='/api')
 uvicorn.run(app, host="0.0.0.0", port=8000)
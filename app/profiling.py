@@ -0,0 +1,176 @@
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import jwt
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api.v1.auth.jwt import SECRET_KEY, ALGORITHM
+from core import metrics
+from database.models import RoleEnum
+
+logger = logging.getLogger(__name__)
+
+# Профилирование запроса включается заголовком X-Profile от админа или случайной выборкой
+# PROFILE_SAMPLE_RATE. Для такого запроса снимается семплирующий профиль потока event loop
+# в PROFILE_DIR (формат folded stacks для flamegraph), считаются SQL-запросы и их время,
+# а повторы одного и того же запроса (N+1) попадают в заголовок Server-Timing.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.001'))
+PROFILE_N_PLUS_ONE = int(os.getenv('PROFILE_N_PLUS_ONE', '5'))
+
+
+class RequestTrace:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes: Counter = Counter()
+
+    def record(self, statement: str, elapsed: float) -> None:
+        self.queries += 1
+        self.db_time += elapsed
+        self.shapes[statement] += 1
+
+    def repeated(self) -> List[Tuple[str, int]]:
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= PROFILE_N_PLUS_ONE]
+
+
+TRACE: ContextVar[Optional[RequestTrace]] = ContextVar('request_trace', default=None)
+
+
+def install_sql_tracing(engine: AsyncEngine) -> None:
+    # Вне профилируемого запроса обработчики сводятся к одному ContextVar.get
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def __before(conn, cursor, statement, parameters, context, executemany):
+        if TRACE.get() is not None:
+            conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def __after(conn, cursor, statement, parameters, context, executemany):
+        trace = TRACE.get()
+        started = conn.info.get('query_started')
+        if trace is not None and started:
+            trace.record(statement, time.perf_counter() - started.pop())
+
+
+class StackSampler(threading.Thread):
+    """Раз в interval снимает стек потока thread_id. Event loop общий, поэтому в профиль
+    попадают и соседние запросы - это картина потока за время запроса, а не только его."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Dict[str, int] = Counter()
+        self.finished = threading.Event()
+
+    def run(self) -> None:
+        while not self.finished.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.finished.set()
+        self.join()
+
+    def write(self, path: str) -> None:
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{stack} {count}\n')
+
+
+class ProfilingMiddleware:
+    """Чистый ASGI: запрос без профилирования уходит в приложение как есть, без обертки
+    над телом ответа. Server-Timing считается к моменту отправки заголовков ответа."""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def __is_admin(headers: Headers) -> bool:
+        # Только разбор JWT без похода в базу: роль зашита в токен при регистрации
+        authorization = headers.get('Authorization', '')
+        try:
+            prefix, token = authorization.split(' ')
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except (ValueError, jwt.exceptions.PyJWTError):
+            return False
+        return prefix == 'TOKEN' and payload.get('role') == RoleEnum.ADMIN.name
+
+    @staticmethod
+    def __should_profile(headers: Headers) -> bool:
+        if PROFILE_HEADER in headers:
+            return ProfilingMiddleware.__is_admin(headers)
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    @staticmethod
+    def __profile_path(method: str, path: str) -> str:
+        name = re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_')
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        return os.path.join(PROFILE_DIR, f'{stamp}-{method}-{name}.folded')
+
+    @staticmethod
+    def __server_timing(trace: RequestTrace, total: float, method: str, path: str) -> str:
+        timings = [
+            f'total;dur={total * 1000:.1f}',
+            f'db;dur={trace.db_time * 1000:.1f};desc="{trace.queries} queries"',
+            f'app;dur={(total - trace.db_time) * 1000:.1f}',
+        ]
+        repeated = trace.repeated()
+        if repeated:
+            shape, count = repeated[0]
+            logger.warning('N+1 in %s %s: %d x %s', method, path, count, shape)
+            timings.append(f'nplus1;desc="{len(repeated)} shapes, max {count}x"')
+        metrics.inc('profiling.nplus1', len(repeated))
+        return ', '.join(timings)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self.__should_profile(Headers(scope=scope)):
+            await self.app(scope, receive, send)
+            return
+
+        method, path = scope['method'], scope['path']
+        trace = RequestTrace()
+        token = TRACE.set(trace)
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+        sampler.start()
+        started = time.perf_counter()
+
+        async def send_with_timing(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing',
+                               self.__server_timing(trace, time.perf_counter() - started, method, path))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            sampler.stop()
+            TRACE.reset(token)
+            profile_path = self.__profile_path(method, path)
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                sampler.write(profile_path)
+            except OSError:
+                logger.exception('failed to write profile %s', profile_path)
+            metrics.inc('profiling.requests')
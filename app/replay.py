@@ -0,0 +1,235 @@
+"""Воспроизведение записанного потока заявок через crud/order.py.
+
+    python replay.py generate --orders 10000 > flow.ndjson
+    python replay.py run flow.ndjson --database-url postgresql+asyncpg://... --reset
+
+Формат потока - NDJSON, по команде на строку:
+    {"op": "instrument", "ticker": "MEMECOIN", "name": "Meme"}
+    {"op": "user", "user": "u1"}
+    {"op": "deposit", "user": "u1", "ticker": "RUB", "amount": 100000}
+    {"op": "order", "user": "u1", "ref": "o1", "side": "BUY", "ticker": "MEMECOIN", "qty": 5, "price": 100}
+    {"op": "cancel", "user": "u1", "ref": "o1"}
+У заявки может быть поле "tif": GTC (по умолчанию), IOC или FOK.
+Поле "t" (секунды от начала потока) пишет генератор, при воспроизведении оно не используется.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+
+def generate(args) -> None:
+    rnd = random.Random(args.seed)
+    out = sys.stdout
+    users = [f'u{i}' for i in range(args.users)]
+
+    def emit(cmd):
+        out.write(json.dumps(cmd) + '\n')
+
+    emit({"op": "instrument", "ticker": args.ticker, "name": args.ticker})
+    for u in users:
+        emit({"op": "user", "user": u})
+        emit({"op": "deposit", "user": u, "ticker": args.base, "amount": args.deposit_rub})
+        emit({"op": "deposit", "user": u, "ticker": args.ticker, "amount": args.deposit_qty})
+
+    t = 0.0
+    placed = defaultdict(list)
+    for i in range(args.orders):
+        # Пуассоновский поток: интервалы между заявками распределены экспоненциально
+        t += rnd.expovariate(args.rate)
+        user = rnd.choice(users)
+        if placed[user] and rnd.random() < args.cancel_ratio:
+            ref = placed[user].pop(rnd.randrange(len(placed[user])))
+            emit({"op": "cancel", "t": round(t, 6), "user": user, "ref": ref})
+            continue
+        side = rnd.choice(['BUY', 'SELL'])
+        price = None
+        if rnd.random() >= args.market_ratio:
+            if args.price_dist == 'uniform':
+                price = rnd.randint(args.mid - args.spread, args.mid + args.spread)
+            else:
+                price = round(rnd.gauss(args.mid, args.spread))
+            price = max(1, price)
+        ref = f'o{i}'
+        if price is not None:
+            placed[user].append(ref)
+        emit({"op": "order", "t": round(t, 6), "user": user, "ref": ref, "side": side,
+              "ticker": args.ticker, "qty": rnd.randint(1, args.qty_max), "price": price})
+
+
+def __percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+
+async def __reset_schema():
+    from database.database import engine, Base
+    import database.models  # noqa: F401
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def __state_hash() -> str:
+    # Хэш итогового состояния не зависит от случайных uuid: пользователи берутся по имени
+    from sqlalchemy import select, asc
+    from database.database import async_session_maker
+    from database.models import User, UserInventory, Order, OrderStatusEnum
+
+    async with async_session_maker() as session:
+        users = (await session.execute(select(User.id, User.name, User.balance))).all()
+        names = {u.id: u.name for u in users}
+        inventories = (await session.execute(
+            select(UserInventory.user_id, UserInventory.instrument_ticker, UserInventory.quantity)
+        )).all()
+        book = (await session.execute(
+            select(Order.user_id, Order.instrument_ticker, Order.direction, Order.price, Order.amount, Order.filled)
+            .where(Order.status.in_([OrderStatusEnum.NEW, OrderStatusEnum.PARTIALLY_EXECUTED]))
+            .order_by(Order.instrument_ticker, Order.direction, asc(Order.price), Order.created_at)
+        )).all()
+    state = {
+        "balances": sorted([names[u.id], u.balance] for u in users),
+        "inventories": sorted([names[i.user_id], i.instrument_ticker, i.quantity] for i in inventories),
+        "books": [[names[o.user_id], o.instrument_ticker, o.direction.name, o.price, o.amount, o.filled] for o in book],
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+async def __count_trades() -> int:
+    from sqlalchemy import select, func
+    from database.database import async_session_maker
+    from database.models import Transaction
+    async with async_session_maker() as session:
+        return (await session.execute(select(func.count()).select_from(Transaction))).scalar()
+
+
+async def replay(args) -> dict:
+    from crud.instrument import create_instrument
+    from crud.order import (create_limit_buy_order, create_limit_sell_order, create_market_buy_order,
+                            create_market_sell_order, cancel_order)
+    from crud.user import create_user, change_balance
+    from database.models import TimeInForceEnum
+
+    if args.reset:
+        await __reset_schema()
+
+    users = dict()
+    refs = dict()
+    latencies = defaultdict(list)
+    rejected = defaultdict(int)
+    trades_before = await __count_trades()
+    matching_time = 0.0
+
+    with open(args.flow) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            cmd = json.loads(line)
+            op = cmd['op']
+            started = time.perf_counter()
+            try:
+                if op == 'instrument':
+                    await create_instrument(cmd.get('name', cmd['ticker']), cmd['ticker'])
+                elif op == 'user':
+                    users[cmd['user']] = await create_user(cmd['user'])
+                elif op == 'deposit':
+                    await change_balance(users[cmd['user']].id, cmd['ticker'], cmd['amount'])
+                elif op == 'order':
+                    user = users[cmd['user']]
+                    tif = TimeInForceEnum[cmd.get('tif', 'GTC')]
+                    if cmd['side'] == 'BUY':
+                        if cmd.get('price'):
+                            order = await create_limit_buy_order(cmd['ticker'], cmd['qty'], cmd['price'], user, tif)
+                        else:
+                            order = await create_market_buy_order(cmd['ticker'], cmd['qty'], user, tif)
+                    else:
+                        if cmd.get('price'):
+                            order = await create_limit_sell_order(cmd['ticker'], cmd['qty'], cmd['price'], user, tif)
+                        else:
+                            order = await create_market_sell_order(cmd['ticker'], cmd['qty'], user, tif)
+                    refs[cmd.get('ref')] = order.id
+                elif op == 'cancel':
+                    order_id = refs.get(cmd['ref'])
+                    if order_id is None or not await cancel_order(str(order_id), users[cmd['user']].id):
+                        rejected[op] += 1
+                else:
+                    raise ValueError(f'unknown op {op}')
+            except Exception:
+                if op not in ('order', 'cancel'):
+                    raise
+                rejected[op] += 1
+            elapsed = time.perf_counter() - started
+            latencies[op].append(elapsed)
+            if op in ('order', 'cancel'):
+                matching_time += elapsed
+
+    fills = await __count_trades() - trades_before
+    report = {
+        "commands": {op: len(v) for op, v in latencies.items()},
+        "rejected": dict(rejected),
+        "fills": fills,
+        "matching_seconds": round(matching_time, 6),
+        "fills_per_second": round(fills / matching_time, 2) if matching_time else 0.0,
+        "latency_ms": {
+            op: {
+                "mean": round(sum(v) / len(v) * 1000, 3),
+                "p50": round(__percentile(v, 50) * 1000, 3),
+                "p90": round(__percentile(v, 90) * 1000, 3),
+                "p99": round(__percentile(v, 99) * 1000, 3),
+                "max": round(max(v) * 1000, 3),
+            } for op, v in latencies.items()
+        },
+        "state_hash": await __state_hash(),
+    }
+    from database.database import engine
+    await engine.dispose()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Order-flow replay harness')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help='write synthetic order flow as NDJSON to stdout')
+    gen.add_argument('--orders', type=int, default=10000)
+    gen.add_argument('--users', type=int, default=50)
+    gen.add_argument('--ticker', default='MEMECOIN')
+    gen.add_argument('--base', default=os.getenv('BASE_INSTRUMENT_TICKER', 'RUB'))
+    gen.add_argument('--rate', type=float, default=100.0, help='mean arrivals per second (Poisson)')
+    gen.add_argument('--price-dist', choices=['normal', 'uniform'], default='normal')
+    gen.add_argument('--mid', type=int, default=100)
+    gen.add_argument('--spread', type=int, default=5, help='stddev for normal, half-width for uniform')
+    gen.add_argument('--market-ratio', type=float, default=0.1)
+    gen.add_argument('--cancel-ratio', type=float, default=0.1)
+    gen.add_argument('--qty-max', type=int, default=10)
+    gen.add_argument('--deposit-rub', type=int, default=10_000_000)
+    gen.add_argument('--deposit-qty', type=int, default=100_000)
+    gen.add_argument('--seed', type=int, default=1)
+
+    run = sub.add_parser('run', help='replay NDJSON flow through crud/order.py')
+    run.add_argument('flow')
+    run.add_argument('--database-url', help='overrides DATABASE_URL / POSTGRES_* settings')
+    run.add_argument('--reset', action='store_true', help='drop and recreate all tables before replay')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+        return
+
+    # crud читает настройки из окружения при импорте, поэтому задаем их до него
+    os.environ.setdefault('BASE_INSTRUMENT_TICKER', 'RUB')
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    print(json.dumps(asyncio.run(replay(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()